@@ -1,72 +1,24 @@
-from ij import IJ, ImagePlus, ImageStack
-from ij import WindowManager
-from ij.process import ImageProcessor, FloatProcessor, ByteProcessor
-from ij.plugin import Concatenator
-from ij.plugin import ChannelSplitter
+from ij import IJ
+from spots_to_membrane.spotsToMembrane import assembleTrainingSet, openLazily
 import os
 from random import shuffle
 
 # Picking the sources.
 folder = IJ.getDirectory("Choose a folder")
+out_folder = IJ.getDirectory("Choose a folder to save the training set")
 keep = 0.8
-content = os.listdir(folder)
+content = [f for f in os.listdir(folder) if f.endswith(".tif")]
 shuffle(content)
 content = content[:int(len(content)*keep)]
 
-images = [IJ.openImage(os.path.join(folder, f)) for f in content]
-# images = [WindowManager.getImage(i) for i in WindowManager.getImageTitles() if not i.startswith("uniform")]
 print("Working with images:")
-for t in images:
-	print("   - " + t.getTitle() + " > (" + str(t.getNChannels()) + ", " + str(t.getNSlices()) + ", " + str(t.getNFrames()) + ")")
-maxSize = 0
-cct = Concatenator()
+for t in content:
+	print("   - " + t)
 
-for img in images:
-	if img.getNSlices() > maxSize:
-		maxSize = img.getNSlices()
-	nc = img.getNChannels()
-		
-print("Biggest stack: " + str(maxSize))
+# The images are read one at a time and the result is written directly to the disk.
+out_path = os.path.join(out_folder, "uniform-training-set.tif")
+assembleTrainingSet([os.path.join(folder, f) for f in content], out_path)
 
-frames = []
-for img in images:
-	# Adding black slice at the begining:
-	bu_out = ImageStack(img.getWidth(), img.getHeight())
-	channels = ChannelSplitter.split(img)
-	# for _ in range(nc):
-	# 	prc    = ByteProcessor(img.getWidth(), img.getHeight())
-	# 	bu_out.addSlice(prc)
-	
-	# Copying slices:
-	for i in range(1, img.getNSlices()+1):
-		for j in range(nc):
-			img = channels[j]
-			img.setSlice(i)
-			bu_out.addSlice(img.getProcessor())
-	
-	# Adding black slices to reach target size:
-	for i in range(maxSize - img.getNSlices()):
-		for _ in range(nc):
-			prc = ByteProcessor(img.getWidth(), img.getHeight())
-			bu_out.addSlice(prc)
-
-	for c in channels:
-		c.close()
-		
-	# Add a last slice of each channel
-	# for _ in range(nc):
-	# 	prc = ByteProcessor(img.getWidth(), img.getHeight())
-	# 	bu_out.addSlice(prc)
-	
-	# Encapsulate in an image
-	imOut = ImagePlus("uniform-"+img.getTitle(), bu_out)
-	imOut.setDimensions(nc, maxSize, 1)
-	frames.append(imOut)
-	img.close()
-
-ts = cct.concatenate(frames, False)
-ns = maxSize
-nf = len(frames)
-print("Final stack: (" + str(nc) + ", " + str(ns) + ", " + str(nf) + ")")
-ts.setDimensions(nc, ns, nf)
+ts = openLazily(out_path)
+print("Final stack: (" + str(ts.getNChannels()) + ", " + str(ts.getNSlices()) + ", " + str(ts.getNFrames()) + ")")
 ts.show()
\ No newline at end of file
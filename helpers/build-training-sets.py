@@ -1,8 +1,7 @@
 import os
-from random import randint, shuffle
+from random import shuffle
 
-from ij import IJ, ImagePlus
-from ij.plugin import Duplicator, Concatenator
+from spots_to_membrane.spotsToMembrane import openLazily, writeAssembledStack
 
 
 """
@@ -12,8 +11,8 @@ Description: Build a training set from a batch of images meant to be used with L
              The only relevant channel is the 3rd one, which is the membrane staining.
              All stacks have a different size, so they can't be assembled as frames.
              In this script, images will be opened sequentially. 
-             Several chunks of 5 slices will be picked and added to a buffer.
-             The final buffer will be the training set.
+             Several chunks of 9 slices will be picked and added to a list of frames.
+             The frames are read back one at a time while the training set is written to the disk.
 
              Note: - Images are normalized before being splitted.
                    - We should also add some randomness (rotations, mirrors, ...)
@@ -21,11 +20,9 @@ Description: Build a training set from a batch of images meant to be used with L
 
 ###########  INIT, GLOBALS AND SETTINGS #############
 
-_dp      = Duplicator()
 _channel = 1
 _s_size  = 9
 _ext     = ".tif" # Extension of images in the folder.
-_cct     = Concatenator()
 _dec_fac = 0.8
 _paths   = [
     "/home/benedetti/Documents/projects/22-spots-to-membrane/data/FL120-cells-no-tentacles/preprocessed-c1-c3/",
@@ -50,39 +47,22 @@ def getContent():
 ############################################
 
 content = getContent() # All files used in the training set
-buffer  = [] # Buffer of stacks
-nFrames = 0
 
 
 for k, source_dir in enumerate(_paths):
+    frames = [] # Chunks as (path, first slice, number of slices)
     for n, c in enumerate(content):
         print("[" + str(n+1) + "/" + str(len(content)) + "]." + " Processing " + c)
         full_path = os.path.join(source_dir, c)
-        imIn      = IJ.openImage(full_path)
+        imIn      = openLazily(full_path)
     
         for i in range(1, imIn.getNSlices()+1, _s_size):
             start = i
             end   = start+_s_size-1
             if (end > imIn.getNSlices()):
                 break
-            
-            chunk = _dp.run(imIn, 1, 1, start, end, 1, 1)
-            """
-            img = Image.wrap(chunk)
-            a = Axes(
-                False, # randint(0, 1) != 0, 
-                False, # randint(0, 1) != 0, 
-                False # randint(0, 1) != 0
-            )
-            _m.run(img, a)
-            out = img.imageplus()
-            """
-            buffer.append(chunk)
-            nFrames += 1
+            frames.append((full_path, start, _s_size))
         imIn.close()
 
-    imOut = _cct.concatenate(buffer, False)
-    imOut.setDimensions(1, _s_size, nFrames)
-    IJ.save(imOut, os.path.join(_path_out, _n_out[k]))
-    imOut.close()
+    writeAssembledStack(frames, [_channel], _s_size, os.path.join(_path_out, _n_out[k]), _n_out[k])
 print("DONE.")
\ No newline at end of file
@@ -0,0 +1,36 @@
+"""
+Geometry of the spots exported by Imaris, independent of ImageJ so it can be checked outside of Fiji.
+"""
+
+
+def isotropicZMapping(pixelWidth, pixelDepth, nSlices):
+    """
+    Values used to invert the Z axis of the spots, as they are on the default isotropic grid (Z stretched to the XY pixel size).
+    The same values are used whatever the grid of the mask (native, isotropic or custom voxel size), so a spot always gets the same Z.
+
+    Args:
+        pixelWidth (float): The XY pixel size of the native (padded) stack.
+        pixelDepth (float): The Z step of the native stack.
+        nSlices (int): The number of slices of the native stack, padding included.
+
+    Returns:
+        (float, float): The total depth of the stack and the offset accounting for the padding.
+    """
+    factor = pixelDepth / pixelWidth
+    depth  = int(nSlices * factor)
+    return pixelWidth * depth, pixelWidth / factor
+
+
+def invertZ(z, extent, offset):
+    """
+    Converts the Z coordinate of a spot from Imaris (inverted axis) to the calibrated Z of the mask.
+
+    Args:
+        z (float): The Z coordinate read in the spots file.
+        extent (float): The total depth of the stack.
+        offset (float): The offset accounting for the padding.
+
+    Returns:
+        float: The calibrated Z coordinate.
+    """
+    return extent - z + offset
@@ -1,8 +1,148 @@
-import os, json, re
-from ij import IJ, ImageStack, ImagePlus
-from ij.plugin import ChannelSplitter, Scaler
-from ij.process import ShortProcessor
+import os, json, re, hashlib, time, shutil, math, uuid, threading
+from java.lang import Runtime, Throwable, String
+from java.io import RandomAccessFile
+from java.util.concurrent import Executors, Callable
+from jarray import array, zeros
+from ij import IJ, ImageStack, ImagePlus, VirtualStack, CompositeImage
+from ij.plugin import Scaler
 from ij.measure import Calibration
+from ij.process import ByteProcessor
+from net.imglib2.img.display.imagej import ImageJFunctions
+from net.imglib2.algorithm.morphology.distance import DistanceTransform
+from org.janelia.saalfeldlab.n5 import N5FSReader, N5FSWriter, GzipCompression
+from org.janelia.saalfeldlab.n5.imglib2 import N5Utils
+
+
+class _Task(Callable):
+    """
+    Wraps a Python function and its argument to be submitted to a Java thread pool.
+    Exceptions are caught and returned, so they can be raised again in the calling thread.
+    """
+    def __init__(self, func, item):
+        self.func = func
+        self.item = item
+
+    def call(self):
+        try:
+            return (True, self.func(self.item))
+        except (Exception, Throwable) as e:
+            return (False, e)
+
+
+def parallelMap(func, items, nThreads=None):
+    """
+    Applies a function to each item, using a pool of threads.
+    Jython has no global lock, so the items are really processed simultaneously.
+    If an item raises an exception, it is raised again here once the pool is shut down.
+
+    Args:
+        func (function): The function to apply. It takes a single argument.
+        items (iterable): The items to process.
+        nThreads (int): The number of threads. By default, the number of available cores.
+
+    Returns:
+        list: The results, in the same order as the items.
+    """
+    items = list(items)
+    if nThreads is None:
+        nThreads = Runtime.getRuntime().availableProcessors()
+    nThreads = max(1, min(nThreads, len(items)))
+    if nThreads == 1:
+        return [func(item) for item in items]
+
+    pool = Executors.newFixedThreadPool(nThreads)
+    try:
+        futures = [pool.submit(_Task(func, item)) for item in items]
+        outcomes = [f.get() for f in futures]
+    finally:
+        pool.shutdown()
+
+    for success, value in outcomes:
+        if not success:
+            raise value
+    return [value for _, value in outcomes]
+
+
+def mapSlices(stack, func, nThreads=None):
+    """
+    Applies a function to each slice of a stack, in parallel.
+    The function receives an ImageProcessor sharing its pixels with the stack, so it can modify the slice in place.
+    The slices are accessed directly in the stack: the state of the ImagePlus holding it is never modified.
+    The function must not rely on objects shared between slices unless they are thread-safe.
+
+    Args:
+        stack (ImageStack): The stack to process.
+        func (function): Takes an ImageProcessor, can return a value.
+        nThreads (int): The number of threads. By default, the number of available cores.
+
+    Returns:
+        list: The value returned for each slice, in the order of the stack.
+    """
+    return parallelMap(lambda s: func(stack.getProcessor(s)), range(1, stack.getSize()+1), nThreads)
+
+
+def labelsTable(labels, size):
+    """
+    Builds the lookup table turning some labels to 255 and every other value to 0.
+
+    Args:
+        labels (list): The labels that are part of the mask.
+        size (int): The size of the table: 256 for 8 bits labels, 65536 for 16 bits labels.
+
+    Returns:
+        array: The table, usable with 'ImageProcessor.applyTable'.
+    """
+    table = zeros(size, 'i')
+    for l in labels:
+        if 0 <= l < size:
+            table[l] = 255
+    return table
+
+
+def maskFromLabels(prc, labels, table=None):
+    """
+    Converts a slice of labels to a binary mask in a single pass, with a lookup table.
+    8 and 16 bits labels are supported, 32 bits labels are converted to 16 bits first.
+
+    Args:
+        prc (ImageProcessor): A slice of labels. It is not modified.
+        labels (list): The labels that are part of the mask.
+        table (array): The table built by 'labelsTable' for these labels and this bit depth, to share it between slices. Built here if None.
+
+    Returns:
+        ByteProcessor: The mask (0 or 255).
+    """
+    work = prc.duplicate() if prc.getBitDepth() in [8, 16] else prc.convertToShortProcessor(False)
+    if table is None:
+        table = labelsTable(labels, 256 if work.getBitDepth() == 8 else 65536)
+    work.applyTable(table)
+    return work.convertToByte(False)
+
+
+def labelsToMask(stack, labels, clearEnds=False, nThreads=None):
+    """
+    Converts a stack of labels to a binary mask, without building any intermediate label image.
+    The slices are processed in parallel.
+
+    Args:
+        stack (ImageStack): The labels. It is not modified.
+        labels (list): The labels that are part of the mask.
+        clearEnds (bool): If True, the first and last slices (padding) are left empty.
+        nThreads (int): The number of threads to use. All the processors if None.
+
+    Returns:
+        ImageStack: The mask, as a new 8-bits stack.
+    """
+    n = stack.getSize()
+    table = labelsTable(labels, 256 if stack.getBitDepth() == 8 else 65536) # Read-only, shared by all the slices.
+    def convert(i):
+        if clearEnds and (i == 1 or i == n):
+            return ByteProcessor(stack.getWidth(), stack.getHeight())
+        return maskFromLabels(stack.getProcessor(i), labels, table)
+    stackOut = ImageStack(stack.getWidth(), stack.getHeight())
+    for mask in parallelMap(convert, range(1, n+1), nThreads):
+        stackOut.addSlice(mask)
+    return stackOut
 
 
 def getTargetPath():
@@ -33,7 +173,10 @@ def getOptions():
     """
     Reads the file 'options.json' located in the 'spots-to-membrane' folder.
     Extracts the options from it, and produces a dictionary.
-    The options are the channels to use for the spots and the membrane, and the minimal size of holes to fill.
+    The options are the channels to use for the spots and the membrane, the minimal size of holes to fill,
+    the extra channels to preprocess in addition to the spots and the membrane,
+    the size of the blocks used by the pixel classifier (0 to classify the whole image at once),
+    and whether the products of the stages are cached ('useCache', off by default in the interactive mode).
 
     Returns:
         dict: The options extracted from the file. (or None if the file is not found)
@@ -41,6 +184,22 @@ def getOptions():
     chSpots = 1
     chMembrane = 3
     sizeHoles = 2000
+    chExtra = []
+    tileSize = 0
+    tileDepth = 0
+    tileHalo = None
+    useCache = False
+    cacheFeatures = False
+    featuresCacheSize = 100
+    maskLabels = [1, 2, 3, 6]
+    isotropic = True
+    isoVoxelSize = None
+    exportEngine = "map"
+    holes3D = False
+    watershedSeeds = "minima"
+    seedDistance = 1.0
+    backgroundDistance = 10.0
+    cropMargin = None
 
     ij_dir       = IJ.getDirectory('plugins')
     dir_mri_cia  = "spots-to-membrane"
@@ -53,11 +212,346 @@ def getOptions():
             chSpots = options['chSpots']
             chMembrane = options['chMembrane']
             sizeHoles = options['sizeHoles']
+            chExtra = options.get('chExtra', [])
+            tileSize = options.get('tileSize', 0)
+            tileDepth = options.get('tileDepth', 0)
+            tileHalo = options.get('tileHalo')
+            useCache = options.get('useCache', False)
+            cacheFeatures = options.get('cacheFeatures', False)
+            featuresCacheSize = options.get('featuresCacheSize', 100)
+            maskLabels = options.get('maskLabels', [1, 2, 3, 6])
+            isotropic = options.get('isotropic', True)
+            isoVoxelSize = options.get('isoVoxelSize')
+            exportEngine = options.get('exportEngine', "map")
+            holes3D = options.get('holes3D', False)
+            watershedSeeds = options.get('watershedSeeds', "minima")
+            seedDistance = options.get('seedDistance', 1.0)
+            backgroundDistance = options.get('backgroundDistance', 10.0)
+            cropMargin = options.get('cropMargin')
     else:
         IJ.log("No options file found. Using default values.")
         return None
 
-    return {'chSpots': chSpots, 'chMembrane': chMembrane, 'sizeHoles': sizeHoles}
+    return {
+        'chSpots': chSpots, 
+        'chMembrane': chMembrane, 
+        'sizeHoles': sizeHoles, 
+        'chExtra': chExtra,
+        'tileSize': tileSize,
+        'tileDepth': tileDepth,
+        'tileHalo': tileHalo,
+        'useCache': useCache,
+        'cacheFeatures': cacheFeatures,
+        'featuresCacheSize': featuresCacheSize,
+        'maskLabels': maskLabels,
+        'isotropic': isotropic,
+        'isoVoxelSize': isoVoxelSize,
+        'exportEngine': exportEngine,
+        'holes3D': holes3D,
+        'watershedSeeds': watershedSeeds,
+        'seedDistance': seedDistance,
+        'backgroundDistance': backgroundDistance,
+        'cropMargin': cropMargin
+    }
+
+
+def loadParameters(path):
+    """
+    Reads a parameters file used for batch processing.
+    It is a JSON file containing the same keys as 'options.json', plus some keys replacing the interactions with the user.
+    Missing keys are replaced by their default value:
+        - 'chSpots' (int): Index of the channel with the densest spots.
+        - 'chMembrane' (int): Index of the channel with the membrane staining.
+        - 'sizeHoles' (int): Maximal area (in pixels) of a hole to be filled.
+        - 'holes3D' (bool): Whether holes are filled in 3D (then 'sizeHoles' is a volume in voxels) instead of slice per slice.
+        - 'chExtra' (list): Indices of channels preprocessed in addition to the spots and the membrane.
+        - 'tileSize' (int): Size (in pixels) of the blocks classified at once in X and Y. 0 to classify the whole image.
+        - 'tileDepth' (int): Number of slices of the blocks. 0 to use the whole depth.
+        - 'tileHalo' (int): Margin (in pixels) added around the blocks. Deduced from the classifier if None.
+        - 'maskLabels' (list): Classes of the pixel classifier that are part of the cells.
+        - 'isotropic' (bool): Whether the masks are resampled to isotropic voxels. If False, the native grid is kept.
+        - 'isoVoxelSize' (float): Size (in calibrated unit) of the isotropic voxels. The XY pixel size if None.
+        - 'exportEngine' (str): "map" to read the distances in a distance map, "surface" to query the closest membrane voxel of each spot.
+        - 'cacheFeatures' (bool): Whether to keep the features computed by the classifier in the cache, to reuse them with a new classifier.
+        - 'cropMargin' (float): If not None, only the region around the spots is processed, extended by this margin (in um) in X and Y.
+        - 'backgroundRoi' (list): [x, y, width, height] of an empty area used to remove the background. Estimated if None.
+        - 'useWatershed' (bool): Whether to use a watershed to isolate the cell of interest.
+        - 'watershedSeeds' (str): "minima" to seed the watershed with the extended minima of the distance map, "spots" to seed it with the spots.
+        - 'seedDistance' (float): Spots closer than this distance (in um) are merged in the same marker, with the "spots" seeds.
+        - 'backgroundDistance' (float): Voxels farther than this distance (in um) from every spot are used as background marker, with the "spots" seeds.
+        - 'distThreshold' (float): Distances above this value (in um) are not exported.
+        - 'useCache' (bool): Whether to reuse the products of the stages from a previous run.
+        - 'cacheDir' (str): The folder of the cache. The 'cache' folder of 'spots-to-membrane' if None.
+        - 'cacheSize' (float): Size budget of the cache, in GB. It can temporarily be exceeded, up to twice this size (see CACHE_HARD_CAP).
+        - 'featuresCacheSize' (float): Size budget of the features kept in the cache (see 'cacheFeatures'), in GB. Not counted in 'cacheSize'.
+
+    Args:
+        path (str): The absolute path of the parameters file.
+
+    Returns:
+        dict: The parameters, with defaults filled in.
+    """
+    params = {
+        'chSpots'      : 1,
+        'chMembrane'   : 3,
+        'sizeHoles'    : 2000,
+        'holes3D'      : False,
+        'chExtra'      : [],
+        'tileSize'     : 0,
+        'tileDepth'    : 0,
+        'tileHalo'     : None,
+        'cacheFeatures': False,
+        'maskLabels'   : [1, 2, 3, 6],
+        'isotropic'    : True,
+        'isoVoxelSize' : None,
+        'exportEngine' : "map",
+        'cropMargin'   : None,
+        'backgroundRoi': None,
+        'useWatershed' : False,
+        'watershedSeeds'    : "minima",
+        'seedDistance'      : 1.0,
+        'backgroundDistance': 10.0,
+        'distThreshold': 99.9,
+        'useCache'     : True,
+        'cacheDir'     : None,
+        'cacheSize'    : 20,
+        'featuresCacheSize': 100
+    }
+    with open(path, 'r') as f:
+        params.update(json.load(f))
+    return params
+
+
+def readSources(path):
+    """
+    Reads a 'sources.txt' file: one absolute image path per line.
+    Empty lines and lines starting with '#' are ignored.
+
+    Args:
+        path (str): The path of the manifest.
+
+    Returns:
+        list: The paths of the images to process.
+    """
+    descr = open(path, 'r')
+    content = [c.strip() for c in descr.read().split('\n') if len(c) > 1 and c.strip()[0] != "#"]
+    descr.close()
+    return content
+
+
+def fileHash(path, chunkSize=1 << 20):
+    """
+    Computes the MD5 hash of a file's content, reading it by chunks to avoid loading it entirely.
+    Used to detect that a source image changed even if its path didn't.
+
+    Args:
+        path (str): The path of the file.
+        chunkSize (int): The number of bytes read at once.
+
+    Returns:
+        str: The hexadecimal digest.
+    """
+    h = hashlib.md5()
+    descr = open(path, 'rb')
+    chunk = descr.read(chunkSize)
+    while chunk:
+        h.update(chunk)
+        chunk = descr.read(chunkSize)
+    descr.close()
+    return h.hexdigest()
+
+
+def getSpotsPath(imgPath):
+    """
+    Attempt to find the spots file.
+    It can be located either in the same folder as the image or in a subfolder of which the name starts with "spots".
+
+    Args:
+        imgPath (str): The path to the image.
+
+    Returns:
+        str: The path to the spots file. None if no spots file is found.
+    """
+    imgName = os.path.basename(imgPath)
+    imgDir  = os.path.dirname(imgPath)
+    spotsL  = [f for f in os.listdir(imgDir) if f.lower().startswith("spots") and os.path.isdir(os.path.join(imgDir, f))]
+    spotsN  = None if len(spotsL) == 0 else spotsL[0]
+    noExt   = ".".join(imgName.split('.')[:-1])
+
+    if spotsN is not None:
+        IJ.log("     | Found spots in a subfolder.")
+        spotsDir = os.path.join(imgDir, spotsN)
+    else:
+        IJ.log("     | Found spots in the same folder.")
+        spotsDir = imgDir
+    
+    targetL  = [f for f in os.listdir(spotsDir) if f.startswith(noExt) and f.lower().endswith('.csv')]
+    IJ.log("     | Found spots file: " + str(targetL) + ".")
+    return None if len(targetL) == 0 else os.path.join(spotsDir, targetL[0])
+
+
+def readSpots(spotsPath):
+    """
+    Reads the raw coordinates of the spots exported by Imaris.
+    The first 4 lines of the file don't contain spots.
+
+    Args:
+        spotsPath (str): The path of the CSV file.
+
+    Returns:
+        list: The [X, Y, Z] calibrated coordinates of each spot, as they are in the file (Y and Z inverted).
+    """
+    descr  = open(spotsPath, 'r')
+    for _ in range(4): 
+        descr.readline()
+    buffer = []
+    while True:
+        line = descr.readline()
+        if len(line) == 0:
+            break
+        buffer.append([float(f) for f in line.split(',')[0:3]]) # X, Y, Z coords
+    descr.close()
+    return buffer
+
+
+# Properties describing the part of the original image that is processed, carried from a stage to the next.
+CROP_PROPERTIES = ["crop-bounds", "full-height"]
+
+
+def spotsBounds(spotsPath, imIn, margin):
+    """
+    Computes the XY bounding box of the spots, extended by a margin.
+
+    Args:
+        spotsPath (str): The path of the spots CSV file.
+        imIn (ImagePlus): The original image, for its size and its calibration.
+        margin (float): The margin (in calibrated unit) added on each side of the box.
+
+    Returns:
+        tuple: (x, y, width, height) in pixels, clipped to the image. None if there is no spot.
+    """
+    points = readSpots(spotsPath)
+    if len(points) == 0:
+        return None
+    cb = imIn.getCalibration()
+    height = imIn.getHeight() * cb.pixelHeight
+    xs = [p[0] / cb.pixelWidth for p in points]
+    ys = [(height - p[1]) / cb.pixelHeight for p in points] # Y axis inverted
+    x0 = max(0, int(math.floor(min(xs) - margin / cb.pixelWidth)))
+    y0 = max(0, int(math.floor(min(ys) - margin / cb.pixelHeight)))
+    x1 = min(imIn.getWidth(), int(math.ceil(max(xs) + margin / cb.pixelWidth)) + 1)
+    y1 = min(imIn.getHeight(), int(math.ceil(max(ys) + margin / cb.pixelHeight)) + 1)
+    if (x1 <= x0) or (y1 <= y0):
+        return None
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+def cropImage(imIn, bounds):
+    """
+    Crops all the channels, slices and frames of an image in XY.
+    The position of the crop is kept in the properties (see CROP_PROPERTIES), in calibrated units, so it can be used on another grid:
+        - 'crop-bounds': "X,Y,width,height" of the crop in the original image.
+        - 'full-height': The height of the original image, the spots having an inverted Y axis.
+
+    Args:
+        imIn (ImagePlus): The image to crop. It is not modified.
+        bounds (tuple): (x, y, width, height) of the crop, in pixels.
+
+    Returns:
+        ImagePlus: The cropped image (new pixels).
+    """
+    x, y, w, h = bounds
+    cb    = imIn.getCalibration()
+    stack = imIn.getStack().crop(x, y, 0, w, h, imIn.getStackSize())
+    imOut = ImagePlus(imIn.getTitle(), stack)
+    imOut.setDimensions(imIn.getNChannels(), imIn.getNSlices(), imIn.getNFrames())
+    imOut.setOpenAsHyperStack(imIn.isHyperStack())
+    imOut.setCalibration(cb)
+    imOut.setProperty("crop-bounds", ",".join([str(x * cb.pixelWidth), str(y * cb.pixelHeight), str(w * cb.pixelWidth), str(h * cb.pixelHeight)]))
+    imOut.setProperty("full-height", str(imIn.getHeight() * cb.pixelHeight))
+    return imOut
+
+
+def cropToSpots(imIn, spotsPath, margin):
+    """
+    Crops an image around its spots, to process only the part containing the cell(s) of interest.
+
+    Args:
+        imIn (ImagePlus): The original image. It is not modified.
+        spotsPath (str): The path of the spots CSV file.
+        margin (float): The margin (in calibrated unit) kept around the spots.
+
+    Returns:
+        ImagePlus: The cropped image, or the input image if it couldn't be cropped.
+    """
+    bounds = spotsBounds(spotsPath, imIn, margin)
+    if bounds is None:
+        IJ.log("  > No spots to crop around, the whole image is processed.")
+        return imIn
+    IJ.log("  > Cropping around the spots: " + str(bounds))
+    return cropImage(imIn, bounds)
+
+
+def getCropBounds(imp):
+    """
+    Reads the position of the crop of an image, in the unit of its calibration.
+
+    Args:
+        imp (ImagePlus): An image produced by a stage of the pipeline.
+
+    Returns:
+        tuple: (X, Y, width, height) of the crop. None if the image wasn't cropped.
+    """
+    bounds = imp.getProperty("crop-bounds")
+    if bounds is None:
+        return None
+    return tuple(float(v) for v in str(bounds).split(','))
+
+
+def cropOffset(imp):
+    """
+    Offset, in pixels of the image, to add to its coordinates to get the ones in the whole field of view.
+
+    Returns:
+        tuple: (dx, dy). (0, 0) if the image wasn't cropped.
+    """
+    bounds = getCropBounds(imp)
+    if bounds is None:
+        return (0, 0)
+    cb = imp.getCalibration()
+    return (int(round(bounds[0] / cb.pixelWidth)), int(round(bounds[1] / cb.pixelHeight)))
+
+
+def cropRoi(roi, imp):
+    """
+    Moves a ROI drawn on the original image to the same place on a crop of this image.
+
+    Args:
+        roi (Roi): The ROI, in the coordinates of the original image. It is not modified.
+        imp (ImagePlus): The cropped image.
+
+    Returns:
+        Roi: A new ROI. None if the ROI was None or if it is not entirely inside of the crop.
+    """
+    if (roi is None) or (getCropBounds(imp) is None):
+        return roi
+    dx, dy = cropOffset(imp)
+    moved = roi.clone()
+    moved.setLocation(roi.getXBase() - dx, roi.getYBase() - dy)
+    b = moved.getBounds()
+    if (b.x < 0) or (b.y < 0) or (b.x + b.width > imp.getWidth()) or (b.y + b.height > imp.getHeight()):
+        IJ.log("  > The background ROI is outside of the crop, it will be estimated.")
+        return None
+    return moved
+
+
+def transferCrop(source, target):
+    """
+    Copies the properties describing the crop from an image to the image produced from it.
+    """
+    for k in CROP_PROPERTIES:
+        if source.getProperty(k) is not None:
+            target.setProperty(k, source.getProperty(k))
 
 
 def updateTargetImage(path, imIn):
@@ -90,11 +584,35 @@ def updateTargetImage(path, imIn):
     
 
 
+def channelView(imIn, channel):
+    """
+    Extracts a channel (of the first frame) without copying any data.
+    The returned image shares its pixels with the input image: modifying one modifies the other.
+    The calibration is transferred to the new image.
+
+    Args:
+        imIn (ImagePlus): The (multi-channel) image.
+        channel (int): The index of the channel to extract (1-based).
+
+    Returns:
+        ImagePlus: A single-channel image referencing the slices of the input image.
+    """
+    source = imIn.getStack()
+    stack  = ImageStack(imIn.getWidth(), imIn.getHeight())
+    for z in range(1, imIn.getNSlices()+1):
+        index = imIn.getStackIndex(channel, z, 1)
+        stack.addSlice(source.getSliceLabel(index), source.getPixels(index))
+    imOut = ImagePlus("C" + str(channel) + "-" + imIn.getTitle(), stack)
+    imOut.setCalibration(imIn.getCalibration())
+    return imOut
+
+
 def sandwichPad(imIn):
     """
     Adds a black slice at the beginning and at the end of the stack.
     Can be used with every bit depth.
-    The original image is closed, the returned image is a new instance.
+    The original image is closed, the returned image is a new instance sharing its pixels.
+    Both black slices share a single array, they must not be modified.
     The calibration is transferred to the new image.
     This function doesn't handle multi-channel images.
 
@@ -104,15 +622,13 @@ def sandwichPad(imIn):
     Returns:
         ImagePlus: The padded image, with new empty slices at the beginning and at the end.
     """
-    s1 = imIn.getProcessor().duplicate()
-    s1.max(0)
-    s2 = s1.duplicate()
-    stack = ImageStack(imIn.getWidth(), imIn.getHeight())
-    stack.addSlice(s1)
-    for i in range(1, imIn.getNSlices()+1):
-        imIn.setSlice(i)
-        stack.addSlice(imIn.getProcessor())
-    stack.addSlice(s2)
+    source = imIn.getStack()
+    black  = source.getProcessor(1).createProcessor(imIn.getWidth(), imIn.getHeight()).getPixels()
+    stack  = ImageStack(imIn.getWidth(), imIn.getHeight())
+    stack.addSlice(None, black)
+    for i in range(1, source.getSize()+1):
+        stack.addSlice(source.getSliceLabel(i), source.getPixels(i))
+    stack.addSlice(None, black)
     title = imIn.getTitle()
     calib = imIn.getCalibration()
     imIn.close()
@@ -126,7 +642,8 @@ def padStack(imIn, targetSize):
     Pads the stack with black slices to reach the target size.
     All new slices are added at the end of the stack, not in "sandwich" mode.
     This function can handle multi-channel images.
-    The original image is closed, the returned image is a new instance.
+    The original image is closed, the returned image is a new instance sharing its pixels.
+    All the black slices share a single array, they must not be modified.
 
     Args:
         imIn (ImagePlus): The image to pad.
@@ -136,32 +653,223 @@ def padStack(imIn, targetSize):
         ImagePlus: The padded image containing 'targetSize' slices.
     """
     calib = imIn.getCalibration()
-    stack16 = ImageStack(imIn.getWidth(), imIn.getHeight())
-    ch = ChannelSplitter.split(imIn)
     title = imIn.getTitle()
     nslices = imIn.getNSlices()
-    nchannels = len(ch)
-    imIn.close()
+    nchannels = imIn.getNChannels()
+    source = imIn.getStack()
+    black = source.getProcessor(1).createProcessor(imIn.getWidth(), imIn.getHeight()).getPixels()
+    stack = ImageStack(imIn.getWidth(), imIn.getHeight())
 
     for i in range(1, nslices+1):
-        for j in range(nchannels):
-            ch[j].setSlice(i)
-            prc = ch[j].getProcessor()
-            stack16.addSlice(prc)
+        for j in range(1, nchannels+1):
+            index = imIn.getStackIndex(j, i, 1)
+            stack.addSlice(source.getSliceLabel(index), source.getPixels(index))
 
     for i in range(nslices+1, targetSize+1):
         for j in range(nchannels):
-            prc = ShortProcessor(imIn.getWidth(), imIn.getHeight())
-            stack16.addSlice(prc)
+            stack.addSlice(None, black)
 
-    imShort = ImagePlus("padded", stack16)
-    imShort.setCalibration(calib)
     imIn.close()
-    imShort.setTitle(title)
-    
-    imShort.setDimensions(nchannels, targetSize, 1)
+    imOut = ImagePlus(title, stack)
+    imOut.setCalibration(calib)
+    imOut.setDimensions(nchannels, targetSize, 1)
+
+    return imOut
+
 
-    return imShort
+def openLazily(path):
+    """
+    Opens an image without loading its pixels, when possible (TIFF files).
+    Other formats are fully loaded.
+
+    Args:
+        path (str): The path of the image.
+
+    Returns:
+        ImagePlus: The image, backed by a virtual stack if possible.
+    """
+    imp = IJ.openVirtual(path)
+    if imp is None:
+        imp = IJ.openImage(path)
+    return imp
+
+
+def readChannels(path, channels):
+    """
+    Reads some channels (of the first frame) of an image, without loading the other ones.
+        - TIFF files are opened virtually, so only the planes of the requested channels are read and decoded.
+        - Other formats (ex: ICS) are read by Bio-Formats, one channel at a time.
+    If this fails, the whole image is loaded.
+
+    Args:
+        path (str): The path of the image.
+        channels (list): The indices (1-based) of the channels to read.
+
+    Returns:
+        ImagePlus: A hyperstack containing the requested channels, in the requested order. Its title and calibration are the ones of the file.
+    """
+    sources = {} # For each requested channel: (image, index of the channel in this image).
+    if os.path.splitext(path)[1].lower() in [".tif", ".tiff"]:
+        imp = IJ.openVirtual(path)
+        if imp is not None:
+            sources = dict((c, (imp, c)) for c in channels)
+    else:
+        try:
+            import loci.plugins
+            ImporterOptions = getattr(loci.plugins, "in").ImporterOptions # 'in' is a keyword.
+            for c in set(channels):
+                opts = ImporterOptions()
+                opts.setId(path)
+                opts.setCBegin(0, c - 1)
+                opts.setCEnd(0, c - 1)
+                opts.setTBegin(0, 0)
+                opts.setTEnd(0, 0)
+                sources[c] = (loci.plugins.BF.openImagePlus(opts)[0], 1)
+        except (Exception, Throwable) as e:
+            IJ.log("  > Couldn't read the channels separately (" + str(e) + "), loading the whole image.")
+            sources = {}
+    if len(sources) == 0:
+        imp = IJ.openImage(path)
+        if imp is None:
+            return None
+        sources = dict((c, (imp, c)) for c in channels)
+
+    first  = sources[channels[0]][0]
+    stack  = ImageStack(first.getWidth(), first.getHeight())
+    for z in range(1, first.getNSlices()+1):
+        for i, c in enumerate(channels):
+            imp, ch = sources[c]
+            index = imp.getStackIndex(ch, z, 1)
+            prc   = imp.getStack().getProcessor(index)
+            if channels.index(c) != i: # A channel requested twice must not share its pixels.
+                prc = prc.duplicate()
+            stack.addSlice(imp.getStack().getSliceLabel(index), prc)
+    imOut = ImagePlus(first.getTitle(), stack)
+    imOut.setDimensions(len(channels), first.getNSlices(), 1)
+    imOut.setOpenAsHyperStack(True)
+    imOut.setCalibration(first.getCalibration())
+    for imp in set(imp for imp, _ in sources.values()):
+        imp.close()
+    return imOut
+
+
+class AssembledStack(VirtualStack):
+    """
+    Virtual hyperstack (channels, slices, frames) in which each frame is a range of slices taken from a file on the disk.
+    Frames shorter than the depth of the hyperstack are padded with black slices at the end.
+    Planes are only read when they are requested, and a single source is opened at a time.
+    Saving an image holding this stack writes it plane by plane, so the memory used is bounded by one source image.
+    """
+    def __init__(self, frames, channels, depth):
+        """
+        Args:
+            frames (list): Tuples (path, first slice, number of slices), one per frame.
+            channels (list): Indices (1-based) of the channels to take from each source.
+            depth (int): The number of slices of each frame.
+        """
+        first = openLazily(frames[0][0])
+        VirtualStack.__init__(self, first.getWidth(), first.getHeight(), None, None)
+        self.frames   = frames
+        self.channels = channels
+        self.depth    = depth
+        self.black    = first.getProcessor().createProcessor(first.getWidth(), first.getHeight())
+        self.bits     = first.getBitDepth()
+        self.calib    = first.getCalibration()
+        self.current  = (None, None)
+        first.close()
+
+    def getSize(self):
+        return len(self.channels) * self.depth * len(self.frames)
+
+    def getBitDepth(self):
+        return self.bits
+
+    def _locate(self, n):
+        n -= 1
+        c = n % len(self.channels)
+        z = (n // len(self.channels)) % self.depth
+        t = n // (len(self.channels) * self.depth)
+        return c, z, t
+
+    def _source(self, path):
+        if self.current[0] != path:
+            if self.current[1] is not None:
+                self.current[1].close()
+            self.current = (path, openLazily(path))
+        return self.current[1]
+
+    def getProcessor(self, n):
+        c, z, t = self._locate(n)
+        path, start, count = self.frames[t]
+        if z >= count:
+            return self.black.duplicate()
+        imp = self._source(path)
+        return imp.getStack().getProcessor(imp.getStackIndex(self.channels[c], start+z, 1))
+
+    def getPixels(self, n):
+        return self.getProcessor(n).getPixels()
+
+    def getSliceLabel(self, n):
+        c, z, t = self._locate(n)
+        return os.path.basename(self.frames[t][0])
+
+    def close(self):
+        if self.current[1] is not None:
+            self.current[1].close()
+        self.current = (None, None)
+
+
+def writeAssembledStack(frames, channels, depth, outPath, title):
+    """
+    Assembles frames taken from several files into a hyperstack, and writes it directly to the disk.
+    The calibration is taken from the first source.
+
+    Args:
+        frames (list): Tuples (path, first slice, number of slices), one per frame.
+        channels (list): Indices (1-based) of the channels to take from each source.
+        depth (int): The number of slices of each frame.
+        outPath (str): The path of the TIFF file to produce.
+        title (str): The title of the produced image.
+    """
+    stack = AssembledStack(frames, channels, depth)
+    imOut = ImagePlus(title, stack)
+    imOut.setDimensions(len(channels), depth, len(frames))
+    imOut.setOpenAsHyperStack(True)
+    imOut.setCalibration(stack.calib)
+    IJ.saveAs(imOut, "Tiff", outPath)
+    stack.close()
+    imOut.close()
+
+
+def assembleTrainingSet(paths, outPath, depth=None):
+    """
+    Builds a training set from several images having the same number of channels.
+    Each image becomes a frame, padded with black slices to reach the requested depth (by default, the size of the biggest stack).
+    The images are read one at a time and the result is streamed to the disk.
+
+    Args:
+        paths (list): The paths of the images to assemble.
+        outPath (str): The path of the TIFF file to produce.
+        depth (int): The number of slices of each frame. None to use the size of the biggest stack. No image may be deeper.
+
+    Returns:
+        int: The number of slices of each frame.
+    """
+    frames = []
+    for path in paths:
+        imp = openLazily(path)
+        frames.append((path, 1, imp.getNSlices()))
+        nChannels = imp.getNChannels()
+        imp.close()
+
+    biggest = max(frames, key=lambda f: f[2])
+    IJ.log("Biggest stack: " + str(biggest[2]) + " for: " + os.path.basename(biggest[0]))
+    if depth is None:
+        depth = biggest[2]
+    elif biggest[2] > depth:
+        raise ValueError("The image " + os.path.basename(biggest[0]) + " has more than " + str(depth) + " slices.")
+    writeAssembledStack(frames, range(1, nChannels+1), depth, outPath, "training-set")
+    return depth
 
 
 def lastClassifierVersion(folder):
@@ -195,6 +903,7 @@ def getClassifierPath():
     """
     Attempts to build the absolute path to the most recent classifier file.
     Searches for it in the 'spots-to-membrane' folder, which is located in the 'plugins' directory of ImageJ.
+    The result is kept for the whole session (in the properties of ImageJ), and the folder is only scanned again if it was modified.
 
     Returns:
         str: The absolute path to the most recent classifier file. None if no classifier file is found.
@@ -203,20 +912,108 @@ def getClassifierPath():
     dir_stm = "spots-to-membrane"
     pgPath = os.path.join(plugins_dir, dir_stm)
 
+    stamp = [pgPath, os.path.getmtime(pgPath)]
+    known = IJ.getProperty("stm.classifier-path")
+    if (known is not None) and (list(known[0]) == stamp):
+        return known[1]
+
     f_name = lastClassifierVersion(pgPath)
-    classif_path = os.path.join(pgPath, f_name)
+    classif_path = None if f_name is None else os.path.join(pgPath, f_name)
+    if (classif_path is not None) and not os.path.isfile(classif_path):
+        classif_path = None
 
-    return classif_path if os.path.isfile(classif_path) else None
+    IJ.setProperty("stm.classifier-path", [stamp, classif_path])
+    return classif_path
 
 
-def makeIsotropic(imIn):
+class IsotropicStack(VirtualStack):
+    """
+    Read-only view of a stack stretched along Z, without interpolation.
+    Each slice of the view is the original slice closest to it (same mapping as 'Scaler' without interpolation), so no pixel is copied.
+    The view keeps the pixel arrays of the original slices, so it stays valid if the original image is closed.
+    Modifying a slice of the view modifies all the slices mapped to the same original slice.
+    """
+    def __init__(self, stack, depth):
+        """
+        Args:
+            stack (ImageStack): The stack to stretch.
+            depth (int): The number of slices of the view.
+        """
+        VirtualStack.__init__(self, stack.getWidth(), stack.getHeight(), None, None)
+        self.planes = [stack.getPixels(i) for i in range(1, stack.getSize()+1)]
+        self.proto  = stack.getProcessor(1)
+        self.depth  = depth
+        self.bits   = self.proto.getBitDepth()
+
+    def getSize(self):
+        return self.depth
+
+    def getBitDepth(self):
+        return self.bits
+
+    def sourceIndex(self, n):
+        scale = float(self.depth) / len(self.planes)
+        z = int((n - 1 - self.depth / 2.0) / scale + len(self.planes) / 2.0)
+        return min(max(z, 0), len(self.planes)-1)
+
+    def getPixels(self, n):
+        return self.planes[self.sourceIndex(n)]
+
+    def getProcessor(self, n):
+        prc = self.proto.createProcessor(self.getWidth(), self.getHeight())
+        prc.setPixels(self.getPixels(n))
+        return prc
+
+    def getSliceLabel(self, n):
+        return None
+
+
+class InterleavedStack(VirtualStack):
+    """
+    Read-only view assembling several single-channel stacks as the channels of a hyperstack, without copying them.
+    Stacks having a lower bit depth than the others are converted when a slice is requested.
+    """
+    def __init__(self, stacks):
+        """
+        Args:
+            stacks (list): The stacks (same size) used as channels, in order.
+        """
+        VirtualStack.__init__(self, stacks[0].getWidth(), stacks[0].getHeight(), None, None)
+        self.stacks = stacks
+        self.bits   = max(s.getBitDepth() for s in stacks)
+
+    def getSize(self):
+        return len(self.stacks) * self.stacks[0].getSize()
+
+    def getBitDepth(self):
+        return self.bits
+
+    def getProcessor(self, n):
+        prc = self.stacks[(n-1) % len(self.stacks)].getProcessor((n-1) // len(self.stacks) + 1)
+        if prc.getBitDepth() == self.bits:
+            return prc
+        return prc.convertToShort(False) if self.bits == 16 else prc.convertToFloat()
+
+    def getPixels(self, n):
+        return self.getProcessor(n).getPixels()
+
+    def getSliceLabel(self, n):
+        return None
+
+
+def makeIsotropic(imIn, voxelSize=None, isMask=False):
     """
     Rescales the input image to make it isotropic.
     The original image is closed, and a new ImagePlus is returned.
-    The conversion is artificial, and the image is not interpolated.
+    By default, the Z axis is stretched to reach the XY pixel size, and the image is not interpolated:
+    the result is a read-only view of the original slices (see 'IsotropicStack'), so no slice is copied.
+    If a voxel size is provided, all the axes are rescaled to reach it (ex: to downsample XY for a smaller volume).
+    In this case, the image is averaged when downsized and interpolated otherwise, and masks are thresholded again to stay binary.
 
     Args:
         imIn (ImagePlus): The image to rescale.
+        voxelSize (float): The size of the voxels (in calibrated unit) of the output. The XY pixel size if None.
+        isMask (bool): Whether the image is a binary mask (0 or 255).
     
     Returns:
         ImagePlus: The rescaled image.
@@ -226,22 +1023,527 @@ def makeIsotropic(imIn):
     calib = imIn.getCalibration()
     xy = calib.pixelWidth
     z = calib.pixelDepth
-    factor = z/xy
-    width = imIn.getWidth()
-    height = imIn.getHeight()
+    size = xy if voxelSize is None else float(voxelSize)
+    factor = z/size
+    width = max(1, int(imIn.getWidth() * xy / size))
+    height = max(1, int(imIn.getHeight() * calib.pixelHeight / size))
     nslices = imIn.getNSlices()
     depth = int(nslices * factor)
-    IJ.log("  > Rescaling to isotropic: " + str((width, height, nslices)) + " -> " + str((width, height, depth)))
+    IJ.log("  > Rescaling to isotropic: " + str((imIn.getWidth(), imIn.getHeight(), nslices)) + " -> " + str((width, height, depth)))
 
-    rescaled = Scaler.resize(imIn, width, height, depth, "none")
+    if voxelSize is None:
+        rescaled = ImagePlus(title, IsotropicStack(imIn.getStack(), depth))
+    else:
+        rescaled = Scaler.resize(imIn, width, height, depth, "bilinear average")
+        if isMask:
+            mapSlices(rescaled.getStack(), lambda prc: prc.threshold(127))
     imIn.close()
 
     iso_calib = Calibration()
-    iso_calib.pixelWidth = xy
-    iso_calib.pixelHeight = xy
-    iso_calib.pixelDepth = xy
+    iso_calib.pixelWidth = size
+    iso_calib.pixelHeight = size
+    iso_calib.pixelDepth = size
     iso_calib.setUnit(calib.getUnit())
     rescaled.setCalibration(iso_calib)
     rescaled.setTitle("iso-"+title)
 
     return rescaled, factor
+
+
+def sampleStack(stack, points, calibration=None, interpolate=False):
+    """
+    Reads the values of a stack at many positions at once.
+    The positions are grouped by slice, and the values are read directly in the pixel arrays of the slices:
+    no processor is created and the state of the image holding the stack is not modified.
+    Positions outside of the stack get a value of 0.
+
+    Args:
+        stack (ImageStack): The stack to sample (8, 16 or 32 bits).
+        points (list): Tuples (x, y, z). Pixel coordinates with z being a slice index (1-based), or calibrated coordinates if 'calibration' is provided.
+        calibration (Calibration): If provided, the points are in calibrated units, the origin being the corner of the first slice.
+        interpolate (bool): If True, the value is interpolated (trilinear) between the 8 closest voxels. Otherwise, the voxel containing the point is used.
+
+    Returns:
+        list: The value at each point, in the order of the points.
+    """
+    w, h, n = stack.getWidth(), stack.getHeight(), stack.getSize()
+    mask = {8: 0xff, 16: 0xffff}.get(stack.getBitDepth())
+
+    # Continuous coordinates, in pixels, z starting at 0.
+    if calibration is None:
+        coords = [(float(x), float(y), float(z-1)) for x, y, z in points]
+    else:
+        coords = [(x / calibration.pixelWidth, y / calibration.pixelHeight, z / calibration.pixelDepth) for x, y, z in points]
+        if interpolate: # The origin is the corner of the first voxel, the interpolation expects the centers at integer positions.
+            coords = [(x - 0.5, y - 0.5, z - 0.5) for x, y, z in coords]
+
+    # Each point needs the slice of its voxel, and the next one to interpolate.
+    bySlice = {}
+    for i, (x, y, z) in enumerate(coords):
+        bySlice.setdefault(int(math.floor(z)), []).append(i)
+
+    def voxel(pixels, x, y):
+        if pixels is None or x < 0 or y < 0 or x >= w or y >= h:
+            return 0.0
+        v = pixels[y*w + x]
+        return float(v & mask) if mask is not None else float(v)
+
+    values = [0.0] * len(coords)
+    for z, indices in bySlice.items():
+        current = stack.getPixels(z+1) if 0 <= z < n else None
+        if not interpolate:
+            for i in indices:
+                values[i] = voxel(current, int(math.floor(coords[i][0])), int(math.floor(coords[i][1])))
+            continue
+        following = stack.getPixels(z+2) if 0 <= z+1 < n else None
+        for i in indices:
+            # Voxel centers are at integer coordinates when interpolating.
+            x, y, zf = coords[i]
+            x0, y0 = int(math.floor(x)), int(math.floor(y))
+            fx, fy, fz = x - x0, y - y0, zf - z
+            acc = 0.0
+            for pixels, wz in [(current, 1.0 - fz), (following, fz)]:
+                if wz == 0.0:
+                    continue
+                acc += wz * ((1-fx) * (1-fy) * voxel(pixels, x0, y0) + fx * (1-fy) * voxel(pixels, x0+1, y0)
+                           + (1-fx) * fy * voxel(pixels, x0, y0+1) + fx * fy * voxel(pixels, x0+1, y0+1))
+            values[i] = acc
+    return values
+
+
+def euclideanDistanceMap(stack, spacing, nThreads=None):
+    """
+    Exact Euclidean distance transform of a binary stack, taking the size of the voxels into account.
+    Each foreground voxel receives its distance to the closest background voxel, so the stack doesn't need to be isotropic.
+    The transform is computed in place in a new float stack (viewed through ImgLib2 without copy).
+    It is separable (lower envelope of parabolas along each axis, Felzenszwalb & Huttenlocher):
+    the 1D passes along an axis are independent, so they are distributed over a pool of threads.
+    The seeding and the final square root are done slice per slice in parallel.
+
+    Args:
+        stack (ImageStack): The mask (0 for the background). It is not modified.
+        spacing (list): The size of a voxel along (X, Y, Z), in the unit of the output distances.
+        nThreads (int): The number of threads. By default, the number of available cores.
+
+    Returns:
+        ImageStack: The distance map (32 bits).
+    """
+    if nThreads is None:
+        nThreads = Runtime.getRuntime().availableProcessors()
+    # The background is the seed (0), the foreground starts 'infinitely' far.
+    def seeds(prc):
+        prc = prc.convertToFloatProcessor()
+        prc.multiply(1e30 / 255.0)
+        return prc
+    stackOut = ImageStack(stack.getWidth(), stack.getHeight())
+    for prc in mapSlices(stack, seeds, nThreads):
+        stackOut.addSlice(prc)
+
+    img = ImageJFunctions.wrapFloat(ImagePlus("distances", stackOut))
+    weights = array([s * s for s in spacing[:img.numDimensions()]], 'd')
+    pool = Executors.newFixedThreadPool(nThreads)
+    try:
+        # Several tasks per thread to balance the load when the lines have different costs.
+        DistanceTransform.transform(img, DistanceTransform.DISTANCE_TYPE.EUCLIDIAN, pool, 4 * nThreads, weights)
+    finally:
+        pool.shutdown()
+    mapSlices(stackOut, lambda prc: prc.sqrt(), nThreads)
+    return stackOut
+
+
+def writeChunked(imp, path, properties=None, blockSize=None, nThreads=None):
+    """
+    Saves an image in an N5 container: the planes are split into compressed blocks, each one in its own file.
+    The whole stack is a single 3D dataset ('data'), in the order of the stack. The dimensions, the calibration and
+    some properties of the image are kept as attributes, so 'readChunked' can rebuild the image.
+    The blocks are compressed in parallel.
+
+    Args:
+        imp (ImagePlus): The image (8, 16 or 32 bits). It is neither modified nor closed.
+        path (str): The path of the container (a folder, usually ending with '.n5').
+        properties (list): Names of the properties of 'imp' to store.
+        blockSize (list): Size of the blocks along (X, Y, planes). [128, 128, 16] by default.
+        nThreads (int): The number of threads. By default, the number of available cores.
+    """
+    if nThreads is None:
+        nThreads = Runtime.getRuntime().availableProcessors()
+    cb   = imp.getCalibration()
+    meta = {
+        'title'      : imp.getTitle(),
+        'dimensions' : [imp.getNChannels(), imp.getNSlices(), imp.getNFrames()],
+        'calibration': [cb.pixelWidth, cb.pixelHeight, cb.pixelDepth, cb.getUnit()],
+        'properties' : dict((k, imp.getProperty(k)) for k in (properties or []) if imp.getProperty(k) is not None)
+    }
+    flat = ImageJFunctions.wrap(ImagePlus(imp.getTitle(), imp.getStack())) # Planes as a 3D volume.
+    n5   = N5FSWriter(path)
+    pool = Executors.newFixedThreadPool(nThreads)
+    try:
+        N5Utils.save(flat, n5, "data", blockSize or [128, 128, 16], GzipCompression(), pool)
+    finally:
+        pool.shutdown()
+    n5.setAttribute("/", "imagej", json.dumps(meta))
+
+
+def readChunked(path):
+    """
+    Opens an image saved with 'writeChunked', without loading its pixels.
+    The image is backed by a virtual stack: the blocks are only read (and decompressed) when a plane is accessed.
+    Several processes can read the same container at once.
+
+    Args:
+        path (str): The path of the container.
+
+    Returns:
+        ImagePlus: The image (read-only), with its dimensions, calibration and stored properties. None if it couldn't be read.
+    """
+    n5 = N5FSReader(path)
+    attrs = n5.getAttribute("/", "imagej", String)
+    if (attrs is None) or not n5.datasetExists("data"):
+        return None
+    meta = json.loads(attrs)
+    imp  = ImageJFunctions.wrap(N5Utils.open(n5, "data"), meta['title'])
+    c, z, t = meta['dimensions']
+    imp.setDimensions(c, z, t)
+    cb = Calibration()
+    cb.pixelWidth, cb.pixelHeight, cb.pixelDepth = meta['calibration'][0:3]
+    cb.setUnit(meta['calibration'][3])
+    imp.setCalibration(cb)
+    if c > 1:
+        imp = CompositeImage(imp, CompositeImage.COMPOSITE)
+    for k, v in meta['properties'].items():
+        imp.setProperty(k, v)
+    return imp
+
+
+# Options on which each stage of the pipeline depends, in addition to its upstream product.
+CACHE_STAGES = {
+    'preprocess': ['chSpots', 'chMembrane', 'chExtra', 'backgroundRoi', 'cropMargin'],
+    'segment'   : ['maskLabels', 'isotropic', 'isoVoxelSize'],
+    'refine'    : ['sizeHoles', 'holes3D', 'useWatershed', 'watershedSeeds', 'seedDistance', 'backgroundDistance', 'chMembrane'],
+    'distances' : [],
+    'features'  : ['tileSize', 'tileDepth', 'tileHalo']
+}
+
+# Default size budget (in bytes) of the cache, see CACHE_HARD_CAP.
+CACHE_SIZE = 20 * 1024 * 1024 * 1024
+
+# Entries used less than this number of seconds ago are not evicted, as they may still be read lazily.
+CACHE_GRACE = 30 * 60
+
+# The budget of the cache is soft: recent entries are only evicted once the cache exceeds this multiple of its budget.
+CACHE_HARD_CAP = 2
+
+_hashes = {}
+
+
+def sourceHash(path):
+    """
+    Hash of the content of a file, remembered as long as the file's size and modification time don't change.
+    Avoids reading a big image again each time a cache key is computed.
+
+    Args:
+        path (str): The path of the file.
+
+    Returns:
+        str: The hexadecimal digest.
+    """
+    stamp = (os.path.getsize(path), os.path.getmtime(path))
+    known = _hashes.get(path)
+    if (known is None) or (known[0] != stamp):
+        known = (stamp, fileHash(path))
+        _hashes[path] = known
+    return known[1]
+
+
+def getCacheDir():
+    """
+    The cache is located in a 'cache' folder, inside the 'spots-to-membrane' folder.
+
+    Returns:
+        str: The absolute path of the cache folder.
+    """
+    return os.path.join(IJ.getDirectory('plugins'), "spots-to-membrane", "cache")
+
+
+def stageKey(stage, options, upstream, extra=None):
+    """
+    Builds the key under which the product of a stage is cached.
+    The key only depends on what the stage reads, so changing an option only invalidates the stages using it (and the following ones).
+
+    Args:
+        stage (str): The name of the stage, one of CACHE_STAGES.
+        options (dict): The options (or batch parameters). Only the ones used by the stage are considered.
+        upstream (str): The key of the product consumed by the stage, or the hash of the source image for the first stage.
+        extra (object): Anything else the stage depends on (ex: classifier version, hash of the spots file).
+
+    Returns:
+        str: The key, usable as a file name.
+    """
+    relevant = [(k, options.get(k)) for k in CACHE_STAGES[stage]]
+    payload  = json.dumps([stage, relevant, upstream, extra], sort_keys=True)
+    return stage + "-" + hashlib.md5(payload).hexdigest()
+
+
+_cacheLock = threading.Lock()
+
+
+def cacheLocked(cacheDir, func):
+    """
+    Runs a function while holding the lock of the cache.
+    The lock is a file of the cache folder ('.lock'), so it is shared by all the processes using this folder (ex: batch workers).
+
+    Args:
+        cacheDir (str): The cache folder.
+        func (function): Called without arguments.
+
+    Returns:
+        object: The value returned by 'func'.
+    """
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    _cacheLock.acquire() # A file lock can't be taken twice by the same JVM.
+    try:
+        descr = RandomAccessFile(os.path.join(cacheDir, ".lock"), "rw")
+        try:
+            lock = descr.getChannel().lock()
+            try:
+                return func()
+            finally:
+                lock.release()
+        finally:
+            descr.close()
+    finally:
+        _cacheLock.release()
+
+
+def cacheLoad(key, cacheDir=None):
+    """
+    Opens a product from the cache.
+    Products are N5 containers, opened without loading their pixels (see 'readChunked'). TIFF files written by older versions are still read.
+    The properties stored along with it are restored, and the entry is marked as recently used.
+
+    Args:
+        key (str): The key of the product.
+        cacheDir (str): The cache folder. The default one if None.
+
+    Returns:
+        ImagePlus: The cached product. None if it is not in the cache.
+    """
+    cacheDir = cacheDir or getCacheDir()
+    base = os.path.join(cacheDir, key)
+    path = base + ".n5" if os.path.isdir(base + ".n5") else base + ".tif"
+    if not os.path.exists(path):
+        return None
+    def touch(): # Marked as used before being read, so it can't be evicted meanwhile.
+        try:
+            now = time.time()
+            os.utime(path, (now, now))
+            return True
+        except OSError:
+            return False
+    if not cacheLocked(cacheDir, touch):
+        return None
+    if path.endswith(".n5"):
+        imp = readChunked(path)
+    else:
+        imp = IJ.openImage(path)
+        if (imp is not None) and os.path.isfile(base + ".json"):
+            with open(base + ".json", 'r') as f:
+                for k, v in json.load(f).items():
+                    imp.setProperty(k, v)
+    return imp
+
+
+def folderSize(path):
+    """
+    Size of all the files in a folder. Files removed during the walk are ignored.
+
+    Args:
+        path (str): The folder.
+
+    Returns:
+        int: The size in bytes.
+    """
+    total = 0
+    for root, _, names in os.walk(path):
+        for n in names:
+            try:
+                total += os.path.getsize(os.path.join(root, n))
+            except OSError:
+                pass
+    return total
+
+
+def cacheRecordSize(path, size=None):
+    """
+    Writes the size of an N5 entry of the cache next to it ('<key>.size'), so the eviction doesn't have to walk its blocks.
+
+    Args:
+        path (str): The path of the container.
+        size (int): Its size in bytes. Computed if None.
+    """
+    if size is None:
+        size = folderSize(path)
+    with open(os.path.splitext(path)[0] + ".size", 'w') as f:
+        f.write(str(size))
+
+
+def cacheEvict(cacheDir=None, maxBytes=CACHE_SIZE, features=False):
+    """
+    Removes the least recently used products until the cache is smaller than 'maxBytes'.
+    The cache is locked during the eviction (see 'cacheLocked').
+
+    Args:
+        cacheDir (str): The cache folder. The default one if None.
+        maxBytes (int): The size budget of the cache.
+        features (bool): If True, only the features containers are considered, with their own budget. Otherwise, they are ignored.
+    """
+    cacheDir = cacheDir or getCacheDir()
+    cacheLocked(cacheDir, lambda: _evict(cacheDir, maxBytes, features))
+
+
+def _evict(cacheDir, maxBytes, features=False):
+    """
+    Removes the least recently used products until the cache is smaller than 'maxBytes'. The cache must be locked.
+    The features containers have their own budget: they are either the only entries considered, or ignored.
+    Products are either TIFF files (with their properties) or N5 containers (folders) with their size in a '.size' file.
+    Entries used in the last CACHE_GRACE seconds are kept, as another process may still be reading them,
+    unless the cache exceeds CACHE_HARD_CAP times 'maxBytes': then they are evicted too (oldest first) down to this cap.
+    Temporary products older than CACHE_GRACE (left by an interrupted process) are removed.
+
+    Args:
+        cacheDir (str): The cache folder.
+        maxBytes (int): The size budget of the cache (or of the features).
+        features (bool): Whether the features containers are evicted instead of the products.
+    """
+    limit = time.time() - CACHE_GRACE
+    entries = []
+    for f in os.listdir(cacheDir):
+        path = os.path.join(cacheDir, f)
+        try:
+            mtime = os.path.getmtime(path)
+            if f.endswith(".tmp"):
+                if (mtime < limit) and os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif mtime < limit:
+                    os.remove(path)
+            elif f.startswith("features-") != features:
+                continue
+            elif f.endswith(".tif"):
+                entries.append((mtime, os.path.getsize(path), path))
+            elif f.endswith(".n5") and os.path.isdir(path):
+                sizePath = path[:-3] + ".size"
+                if os.path.isfile(sizePath):
+                    with open(sizePath, 'r') as descr:
+                        size = int(descr.read())
+                else:
+                    size = folderSize(path)
+                entries.append((mtime, size, path))
+        except (OSError, IOError, ValueError): # Removed or being written by another process.
+            continue
+    total = sum(e[1] for e in entries)
+    kept  = []
+    for mtime, size, path in sorted(entries):
+        if total <= maxBytes:
+            break
+        if mtime >= limit:
+            kept.append((mtime, size, path))
+        elif _removeEntry(path):
+            total -= size
+    # Recent entries are only evicted to stay under the hard cap.
+    for mtime, size, path in kept:
+        if total <= CACHE_HARD_CAP * maxBytes:
+            break
+        if _removeEntry(path):
+            total -= size
+    if total > maxBytes:
+        IJ.log("     | Cache over budget (recent entries kept): " + str(total // (1024 * 1024)) + " MB for " + str(maxBytes // (1024 * 1024)) + " MB")
+
+
+def _removeEntry(path):
+    """
+    Removes an entry of the cache (TIFF file or N5 container) along with its sidecar files. The cache must be locked.
+
+    Args:
+        path (str): The path of the entry.
+
+    Returns:
+        bool: True if the entry was removed.
+    """
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        for p in [path, os.path.splitext(path)[0] + ".json", os.path.splitext(path)[0] + ".size"]:
+            if os.path.isfile(p):
+                os.remove(p)
+    except OSError:
+        return False
+    IJ.log("     | Evicted from cache: " + os.path.basename(path))
+    return True
+
+
+def cacheStore(key, imp, properties=None, cacheDir=None, maxBytes=CACHE_SIZE):
+    """
+    Saves a product in the cache, along with some of its properties, as a chunked and compressed N5 container.
+    The container is written under a temporary name (unique across processes) and then renamed, so a concurrent reader never sees a partial product.
+    The publication and the eviction that follows are done while holding the lock of the cache.
+
+    Args:
+        key (str): The key of the product.
+        imp (ImagePlus): The product. It is neither modified nor closed.
+        properties (list): Names of the properties of 'imp' to store.
+        cacheDir (str): The cache folder. The default one if None.
+        maxBytes (int): The size budget of the cache.
+    """
+    cacheDir = cacheDir or getCacheDir()
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    base = os.path.join(cacheDir, key)
+    tmp  = base + "." + uuid.uuid4().hex + ".tmp"
+    try:
+        writeChunked(imp, tmp, properties)
+    except:
+        shutil.rmtree(tmp, True) # Don't leave a partial container behind.
+        raise
+    size = folderSize(tmp)
+    def publish():
+        if os.path.isdir(base + ".n5"): # Stored by another worker in the meantime.
+            shutil.rmtree(tmp)
+        else:
+            os.rename(tmp, base + ".n5")
+            cacheRecordSize(base + ".n5", size)
+        _evict(cacheDir, maxBytes)
+    cacheLocked(cacheDir, publish)
+
+
+def cachedProduct(key, producer, properties=None, cacheDir=None, maxBytes=CACHE_SIZE):
+    """
+    Returns the product of a stage from the cache, or produces it and stores it.
+    The producer is only called on a cache miss, so a hit on a late stage skips all the stages before it.
+    The key is set as the 'cache-key' property of the product, to be used as upstream key by the next stage.
+
+    Args:
+        key (str): The key of the product. If None, the cache is bypassed.
+        producer (function): Called without arguments to build the product (ImagePlus) on a miss.
+        properties (list): Names of the properties to store along with the product.
+        cacheDir (str): The cache folder. The default one if None.
+        maxBytes (int): The size budget of the cache.
+
+    Returns:
+        ImagePlus: The product (even if it couldn't be stored). None if the producer failed.
+    """
+    if key is None:
+        return producer()
+    imp = cacheLoad(key, cacheDir)
+    if imp is not None:
+        IJ.log("  > Found in cache: " + key)
+    else:
+        imp = producer()
+        if imp is None:
+            return None
+        try:
+            cacheStore(key, imp, properties, cacheDir, maxBytes)
+        except (Exception, Throwable) as e:
+            IJ.log("  > Couldn't store in cache (" + str(e) + ")")
+    imp.setProperty("cache-key", key)
+    return imp
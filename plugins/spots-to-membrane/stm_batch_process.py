@@ -0,0 +1,310 @@
+import os, sys, time
+from java.lang import Throwable, ProcessBuilder, System
+from java.io import File
+from ij import IJ
+from ij.gui import GenericDialog, Roi
+from ij.measure import ResultsTable
+from spots_to_membrane.spotsToMembrane import loadParameters, parallelMap, readSources, getClassifierPath, sourceHash, stageKey, cachedProduct, getSpotsPath, cropToSpots, cropRoi, transferCrop, CROP_PROPERTIES
+
+# The stages are regular plugins of this folder, we import them as modules.
+sys.path.append(os.path.join(IJ.getDirectory('plugins'), "spots-to-membrane"))
+from stm_preprocess_stddev import preprocessImage, readForPreprocessing
+from stm_rough_cells_segmentation import segmentImage
+from stm_import_points import importSpots
+from stm_refine_segmentation import refineSegmentation
+from stm_export_distances import distanceTransform, measureDistances, measureSurfaceDistances
+
+
+def getDistancesPath(imgPath, outDir):
+    """
+    Builds the path of the CSV file in which the distances of an image are written.
+
+    Args:
+        imgPath (str): The path of the original image.
+        outDir (str): The output folder of the batch.
+
+    Returns:
+        str: The path of the CSV file.
+    """
+    imgName = os.path.basename(imgPath)
+    noExt   = ".".join(imgName.split('.')[:-1]) if '.' in imgName else imgName
+    return os.path.join(outDir, "distances-" + noExt + ".csv")
+
+
+def processImage(imgPath, params, outDir):
+    """
+    Runs the whole pipeline (f1 -> f6) on one image, without any interaction and without showing windows.
+    The manual dumping of spots (f5) is not part of the batch: every spot is exported with its ID.
+    Unless 'useCache' is False, the products of the stages are cached, and a stage is only run if its product is not in the cache.
+    If 'cropMargin' is set, the image is cropped around its spots before the first stage, and the positions are exported in the whole image.
+
+    Args:
+        imgPath (str): The path of the original image.
+        params (dict): The parameters, as produced by 'loadParameters'.
+        outDir (str): The folder in which the distances are written.
+
+    Returns:
+        str: The path of the CSV file containing the distances.
+    """
+    roi = None
+    if params['backgroundRoi'] is not None:
+        x, y, w, h = params['backgroundRoi']
+        roi = Roi(x, y, w, h)
+
+    spotsPath = getSpotsPath(imgPath)
+    if spotsPath is None:
+        raise IOError("Couldn't find the spots for: " + imgPath)
+
+    if not os.path.isfile(imgPath):
+        raise IOError("Couldn't open the image: " + imgPath)
+    classifierPath = getClassifierPath()
+    if classifierPath is None:
+        raise IOError("Couldn't find the pixel classifier in the 'spots-to-membrane' folder.")
+
+    cacheDir = params['cacheDir']
+    maxBytes = int(params['cacheSize'] * 1024 * 1024 * 1024)
+    cropped = params['cropMargin'] is not None
+    keys = [None] * 4
+    if params['useCache']:
+        keys[0] = stageKey('preprocess', params, sourceHash(imgPath), sourceHash(spotsPath) if cropped else None)
+        keys[1] = stageKey('segment', params, keys[0], os.path.basename(classifierPath))
+        keys[2] = stageKey('refine', params, keys[1], sourceHash(spotsPath))
+        keys[3] = stageKey('distances', params, keys[2])
+
+    # [f1] Preprocessing
+    def preprocessed():
+        imIn, local = readForPreprocessing(imgPath, params)
+        if imIn is None:
+            raise IOError("Couldn't open the image: " + imgPath)
+        title = imIn.getTitle()
+        clb   = imIn.getCalibration()
+        if cropped:
+            imCrop = cropToSpots(imIn, spotsPath, params['cropMargin'])
+            if imCrop is not imIn:
+                imIn.close()
+            imIn = imCrop
+        imPrp = preprocessImage(imIn, local, cropRoi(roi, imIn), True)
+        imPrp.setCalibration(clb)
+        imPrp.setTitle(title)
+        transferCrop(imIn, imPrp)
+        imIn.close()
+        return imPrp
+
+    # [f2] Rough segmentation
+    def rough():
+        imPrp = cachedProduct(keys[0], preprocessed, CROP_PROPERTIES, cacheDir, maxBytes)
+        mask  = segmentImage(imPrp, params)
+        imPrp.close()
+        if mask is None:
+            raise RuntimeError("Segmentation failed.")
+        return mask
+    mask = cachedProduct(keys[1], rough, ["anisotropy-factor", "z-mapping"] + CROP_PROPERTIES, cacheDir, maxBytes)
+
+    # [f3] Spots import
+    spots = importSpots(mask, imgPath, ResultsTable())
+    if spots is None:
+        mask.close()
+        raise IOError("Couldn't find the spots for: " + imgPath)
+
+    # [f4] Refined segmentation
+    def refined():
+        return refineSegmentation(mask, spots, imgPath, params['useWatershed'], params)
+
+    # [f6] Distances export
+    locations = [(i, int(spots.getValue("pX", i)), int(spots.getValue("pY", i)), int(spots.getValue("pZ", i))) for i in range(spots.size())]
+    if params['exportEngine'] == "surface":
+        control = cachedProduct(keys[2], refined, CROP_PROPERTIES, cacheDir, maxBytes)
+        mask.close()
+        positions = [(spots.getValue("X", i), spots.getValue("Y", i), spots.getValue("Z", i)) for i in range(spots.size())]
+        rt = measureSurfaceDistances(control, locations, params['distThreshold'], positions)
+        control.close()
+    else:
+        def distances():
+            control = cachedProduct(keys[2], refined, CROP_PROPERTIES, cacheDir, maxBytes)
+            distMap = distanceTransform(control)
+            control.close()
+            return distMap
+        distMap = cachedProduct(keys[3], distances, CROP_PROPERTIES, cacheDir, maxBytes)
+        mask.close()
+        rt = measureDistances(distMap, locations, params['distThreshold'])
+        distMap.close()
+
+    csvPath = getDistancesPath(imgPath, outDir)
+    rt.save(csvPath)
+    return csvPath
+
+
+def writeSummary(outDir, rows):
+    """
+    Writes the status of each image of the batch in 'batch-summary.csv'.
+
+    Args:
+        outDir (str): The output folder of the batch.
+        rows (list): Tuples (image path, status, details).
+    """
+    descr = open(os.path.join(outDir, "batch-summary.csv"), 'w')
+    descr.write("Image,Status,Details\n")
+    for row in rows:
+        descr.write(",".join(['"' + str(r).replace('"', "'") + '"' for r in row]) + "\n")
+    descr.close()
+
+
+def runBatch(sourcesPath, paramsPath, outDir):
+    """
+    Processes every image of the manifest with the same parameters, one after the other, in this JVM.
+    An image failing doesn't interrupt the batch, the error is logged and the next image is processed.
+
+    Args:
+        sourcesPath (str): Path of the 'sources.txt' manifest.
+        paramsPath (str): Path of the JSON parameters file.
+        outDir (str): Folder where the CSV files are written.
+
+    Returns:
+        list: Tuples (image path, status, details) for each image.
+    """
+    params  = loadParameters(paramsPath)
+    sources = readSources(sourcesPath)
+    rows    = []
+
+    for i, imgPath in enumerate(sources):
+        IJ.log("=======  [" + str(i+1) + "/" + str(len(sources)) + "] " + imgPath + "  ========")
+        try:
+            csvPath = processImage(imgPath, params, outDir)
+            IJ.log("==> Distances saved to: " + csvPath)
+            rows.append((imgPath, "OK", csvPath))
+        except (Exception, Throwable) as e:
+            IJ.log("==> FAILED: " + str(e))
+            rows.append((imgPath, "FAILED", str(e)))
+
+    return rows
+
+
+def runWorker(command, logPath):
+    """
+    Processes a single image in a new headless Fiji, so a crash (or an out-of-memory) only affects this image.
+    The output of the worker is redirected to a log file.
+
+    Returns:
+        int: The exit code of the worker, or the error message if it couldn't be started.
+    """
+    try:
+        pb = ProcessBuilder(command)
+        pb.redirectErrorStream(True)
+        pb.redirectOutput(File(logPath))
+        return pb.start().waitFor()
+    except (Exception, Throwable) as e:
+        return str(e)
+
+
+def getFijiExecutable():
+    """
+    Finds the launcher of the running Fiji, used to start the workers.
+
+    Returns:
+        str: The path of the executable. None if it couldn't be found.
+    """
+    for key in ["fiji.executable", "ij.executable"]:
+        exe = System.getProperty(key)
+        if exe is not None and os.path.isfile(exe):
+            return exe
+    return None
+
+
+def runPool(sourcesPath, paramsPath, outDir, nWorkers):
+    """
+    Processes every image of the manifest in its own Fiji process, running at most 'nWorkers' of them at once.
+    Each worker runs the sequential batch on a manifest containing a single image.
+    The memory of each worker can be set with the 'workerMemory' parameter (ex: "8g").
+
+    Args:
+        sourcesPath (str): Path of the 'sources.txt' manifest.
+        paramsPath (str): Path of the JSON parameters file.
+        outDir (str): Folder where the CSV files are written.
+        nWorkers (int): Number of images processed simultaneously.
+
+    Returns:
+        list: Tuples (image path, status, details) for each image.
+    """
+    params     = loadParameters(paramsPath)
+    sources    = readSources(sourcesPath)
+    executable = params.get('fijiExecutable') or getFijiExecutable()
+    if executable is None:
+        raise IOError("Couldn't find the Fiji executable, set 'fijiExecutable' in the parameters.")
+
+    workDir = os.path.join(outDir, "batch-workers")
+    if not os.path.isdir(workDir):
+        os.makedirs(workDir)
+
+    tasks = []
+    for i, imgPath in enumerate(sources):
+        manifest = os.path.join(workDir, "%05d.txt" % i)
+        logPath  = os.path.join(workDir, "%05d.log" % i)
+        descr = open(manifest, 'w')
+        descr.write(imgPath + "\n")
+        descr.close()
+        csvPath = getDistancesPath(imgPath, outDir)
+        if os.path.isfile(csvPath): # To be sure that we don't report a result from a previous run.
+            os.remove(csvPath)
+
+        command = [executable, "--headless", "--console"]
+        if params.get('workerMemory') is not None:
+            command.append("--mem=" + str(params['workerMemory']))
+        command += ["--run", "stm batch process", "sources=[" + manifest + "] parameters=[" + paramsPath + "] output=[" + outDir + "] workers=1 worker"]
+        tasks.append((imgPath, csvPath, logPath, command))
+
+    codes = parallelMap(lambda t: runWorker(t[3], t[2]), tasks, nWorkers)
+
+    rows = []
+    for i, ((imgPath, csvPath, logPath, _), code) in enumerate(zip(tasks, codes)):
+        if code == 0 and os.path.isfile(csvPath):
+            IJ.log("[" + str(i+1) + "/" + str(len(tasks)) + "] OK: " + imgPath)
+            rows.append((imgPath, "OK", csvPath))
+        else:
+            IJ.log("[" + str(i+1) + "/" + str(len(tasks)) + "] FAILED (" + str(code) + "): " + imgPath)
+            rows.append((imgPath, "FAILED", logPath))
+
+    return rows
+
+
+def main():
+    # In headless mode, the fields are filled from the arguments: "sources=... parameters=... output=... workers=..."
+    # 'worker' is only given to the processes started by 'runPool': the summary is written by the parent process.
+    gd = GenericDialog("Batch processing")
+    gd.addFileField("Sources", "")
+    gd.addFileField("Parameters", "")
+    gd.addDirectoryField("Output", "")
+    gd.addNumericField("Workers", 1, 0)
+    gd.addCheckbox("Worker", False)
+    gd.showDialog()
+    if gd.wasCanceled():
+        return 1
+    sourcesPath = gd.getNextString()
+    paramsPath  = gd.getNextString()
+    outDir      = gd.getNextString()
+    nWorkers    = int(gd.getNextNumber())
+    isWorker    = gd.getNextBoolean()
+
+    for p in [sourcesPath, paramsPath]:
+        if not os.path.isfile(p):
+            IJ.log("File not found: " + p)
+            return 1
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+
+    start = time.time()
+    if nWorkers > 1:
+        rows = runPool(sourcesPath, paramsPath, outDir, nWorkers)
+    else:
+        rows = runBatch(sourcesPath, paramsPath, outDir)
+    if not isWorker:
+        writeSummary(outDir, rows)
+
+    failed = [r[0] for r in rows if r[1] != "OK"]
+    IJ.log("Batch done in " + str(int(time.time() - start)) + "s: " + str(len(rows) - len(failed)) + "/" + str(len(rows)) + " images processed.")
+    for f in failed:
+        IJ.log("   - Failed: " + f)
+    return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,13 @@
 from ij import IJ, ImagePlus
-from ij.gui import PointRoi
-from ij.plugin import Duplicator
 from ij.plugin.frame import RoiManager
 from ij.measure import ResultsTable
-from inra.ijpb.binary.distmap import ChamferMask3D
 from ij.plugin import RGBStackMerge
-from inra.ijpb.binary import BinaryImages
-from inra.ijpb.data.image import Images3D
-from ij.gui import Roi
-import os
+from ij.plugin.filter import RankFilters, ThresholdToSelection
+from ij.process import Blitter
+from java.util import ArrayList
+from net.imglib2 import KDTree, RealPoint
+from net.imglib2.neighborsearch import NearestNeighborSearchOnKDTree
+from spots_to_membrane.spotsToMembrane import getOptions, channelView, euclideanDistanceMap, sampleStack, stageKey, cachedProduct, parallelMap, cropOffset, transferCrop, CROP_PROPERTIES
 
 
 def getValuesFromLocations(imChamfer, rm):
@@ -20,59 +19,150 @@ def getValuesFromLocations(imChamfer, rm):
     rt = ResultsTable.getResultsTable()
     rt.reset()
 
-    for s, roi in enumerate(rois):
-        imChamfer.setSlice(s+1)
-        proc = imChamfer.getProcessor()
-        points = roi.getContainedPoints()
-        for point in points:
-            val = proc.getf(point.x, point.y)
-            if val < 1e-6:
-                continue
-            rt.addRow()
-            rt.addValue("Distance", val)
-            rt.addValue("X", point.x)
-            rt.addValue("Y", point.y)
-            rt.updateResults()
-            rt.show("Results")
+    # The ROI at index 's' holds the points of the slice 's+1'.
+    points = [(p.x, p.y, s+1) for s, roi in enumerate(rois) for p in roi.getContainedPoints()]
+    for (x, y, _), val in zip(points, sampleStack(imChamfer.getStack(), points)):
+        if val < 1e-6:
+            continue
+        rt.addRow()
+        rt.addValue("Distance", val)
+        rt.addValue("X", x)
+        rt.addValue("Y", y)
+    rt.show("Results")
 
 
 def distanceTransform(imIn):
     """
     Takes as input the control image in which the first channel is the mask.
-    Extracts the mask and computes the distance transform.
-    The input image is supposed to be isotropic and calibrated.
-    Scales the quasi-Euclidean distance transform to micrometers.
+    Extracts the mask and computes the exact Euclidean distance transform, in calibrated units.
+    The input image can be either isotropic or on the native grid, as the calibration is used for each axis.
     """
-    dp = Duplicator()
-    mask = dp.run(imIn, 1, 1, 1, imIn.getNSlices(), 1, 1)
-    factor = mask.getCalibration().pixelWidth
-    kernel = ChamferMask3D.QUASI_EUCLIDEAN
-    distStack = BinaryImages.distanceMap(mask.getStack(), kernel, True, False)
+    mask = channelView(imIn, 1)
+    cb = mask.getCalibration()
+    distStack = euclideanDistanceMap(mask.getStack(), [cb.pixelWidth, cb.pixelHeight, cb.pixelDepth])
     imOut = ImagePlus("Distance map", distStack)
-    for i in range(1, imOut.getNSlices()+1):
-        imOut.setSlice(i)
-        prc = imOut.getProcessor()
-        prc.multiply(factor)
+    imOut.setCalibration(cb)
+    transferCrop(imIn, imOut)
     mask.close()
     return imOut
 
 
-def extractDistances(distMap, rm, threshold):
+def measureDistances(distMap, spots, threshold):
+    """
+    Reads the distance to the membrane at the location of each spot.
+    Spots further than the threshold from the membrane are ignored.
+    If the map covers a crop, the exported positions are the ones in the whole field of view.
+
+    Args:
+        distMap (ImagePlus): The calibrated distance map.
+        spots (list): Tuples (ID, x, y, z) of uncalibrated coordinates, z being a slice index (1-based).
+        threshold (float): The maximal distance (in um) to export.
+
+    Returns:
+        ResultsTable: A new table with one row per exported spot.
+    """
     rt = ResultsTable()
     rt.reset()
     index = 0
+    values = sampleStack(distMap.getStack(), [(x, y, z) for _, x, y, z in spots])
+    dx, dy = cropOffset(distMap)
 
-    for i in range(rm.getCount()):
-        roi = rm.getRoi(i)
-        z = roi.getZPosition()
-        if not roi.isLineOrPoint():
-            continue
-        points = roi.getContainedPoints()
-        if len(points) != 1:
+    for (i, x, y, z), val in zip(spots, values):
+        if val > threshold:
             continue
-        x, y = int(points[0].x), int(points[0].y)
-        distMap.setSlice(z)
-        val = distMap.getProcessor().getf(x, y)
+        
+        rt.addRow()
+        rt.setValue("ID", index, i)
+        rt.setValue("Distance (um)", index, val)
+        rt.setValue("X", index, x + dx)
+        rt.setValue("Y", index, y + dy)
+        rt.setValue("Z", index, z)
+        index += 1
+    
+    return rt
+
+
+def membraneBoundary(mask):
+    """
+    Lists the voxels of the membrane: background voxels touching the mask (26-connectivity).
+    The closest background voxel to any voxel of the mask is always one of them, so the distances from a voxel center to this set are the ones of the distance map.
+    Each slice is dilated (3x3 maximum), merged with its dilated neighbours and the mask is removed. Slices are processed in parallel.
+
+    Args:
+        mask (ImagePlus): The mask (0 for the background).
+
+    Returns:
+        list: Tuples (x, y, z) of uncalibrated coordinates, z being a slice index (1-based).
+    """
+    stack = mask.getStack()
+    n = stack.getSize()
+
+    def dilated(s):
+        prc = stack.getProcessor(s).convertToByte(False).duplicate() # 8 bits masks would be dilated in place.
+        RankFilters().rank(prc, 1, RankFilters.MAX)
+        return prc
+    dilations = parallelMap(dilated, range(1, n+1))
+
+    def boundary(s):
+        prc = dilations[s-1].duplicate()
+        for k in [s-1, s+1]:
+            if 1 <= k <= n:
+                prc.copyBits(dilations[k-1], 0, 0, Blitter.MAX)
+        prc.copyBits(stack.getProcessor(s).convertToByte(False), 0, 0, Blitter.SUBTRACT)
+        prc.setThreshold(1, 255)
+        roi = ThresholdToSelection.run(ImagePlus("boundary", prc))
+        if roi is None:
+            return []
+        return [(p.x, p.y, s) for p in roi.getContainedPoints()]
+
+    points = []
+    for layer in parallelMap(boundary, range(1, n+1)):
+        points += layer
+    return points
+
+
+def measureSurfaceDistances(control, spots, threshold, positions=None):
+    """
+    Measures the distance from each spot to the membrane without computing a distance map.
+    The membrane voxels are extracted once and indexed in a KD-tree, which is then queried for each spot only.
+    Spots outside of the mask have a distance of 0, like in the distance map.
+    The membrane voxels are represented by their center, and the spots are queried at their calibrated position when it is known (sub-voxel distances).
+    The distances are then approximate: they can differ from the ones queried at the voxel centers (distance map, interactive mode) by up to half a voxel diagonal.
+    If the control image covers a crop, the exported positions are the ones in the whole field of view.
+
+    Args:
+        control (ImagePlus): The control image, the first channel being the mask.
+        spots (list): Tuples (ID, x, y, z) of uncalibrated coordinates, z being a slice index (1-based).
+        threshold (float): The maximal distance (in um) to export.
+        positions (list): Tuples (X, Y, Z) of calibrated coordinates of the spots, in the same order. If None, the center of the voxel of each spot is used.
+
+    Returns:
+        ResultsTable: A new table with one row per exported spot, with the position of the closest membrane voxel.
+    """
+    mask = channelView(control, 1)
+    cb = mask.getCalibration()
+    toPhysical = lambda x, y, z: RealPoint([(x + 0.5) * cb.pixelWidth, (y + 0.5) * cb.pixelHeight, (z - 0.5) * cb.pixelDepth]) # Voxel centers
+
+    boundary = membraneBoundary(mask)
+    IJ.log("     | Membrane voxels: " + str(len(boundary)))
+    search = None
+    if len(boundary) > 0:
+        search = NearestNeighborSearchOnKDTree(KDTree(ArrayList(boundary), ArrayList([toPhysical(x, y, z) for x, y, z in boundary])))
+    if positions is None:
+        queries = [toPhysical(x, y, z) for _, x, y, z in spots]
+    else:
+        queries = [RealPoint([float(X), float(Y), float(Z)]) for X, Y, Z in positions]
+
+    dx, dy = cropOffset(control)
+    rt = ResultsTable()
+    index = 0
+    inside = sampleStack(mask.getStack(), [(x, y, z) for _, x, y, z in spots])
+    for (i, x, y, z), isIn, query in zip(spots, inside, queries):
+        if (search is None) or (isIn == 0):
+            val, nearest = 0.0, (x, y, z)
+        else:
+            search.search(query)
+            val, nearest = search.getDistance(), search.getSampler().get()
 
         if val > threshold:
             continue
@@ -80,13 +170,41 @@ def extractDistances(distMap, rm, threshold):
         rt.addRow()
         rt.setValue("ID", index, i)
         rt.setValue("Distance (um)", index, val)
-        rt.setValue("X", index, x)
-        rt.setValue("Y", index, y)
+        rt.setValue("X", index, x + dx)
+        rt.setValue("Y", index, y + dy)
         rt.setValue("Z", index, z)
+        rt.setValue("Membrane X", index, nearest[0] + dx)
+        rt.setValue("Membrane Y", index, nearest[1] + dy)
+        rt.setValue("Membrane Z", index, nearest[2])
         index += 1
-        rt.updateResults()
-    
     
+    mask.close()
+    return rt
+
+
+def spotsFromRoiManager(rm):
+    """
+    Reads the position of the spots from the ROI manager.
+
+    Returns:
+        list: Tuples (index in the manager, x, y, z) of uncalibrated coordinates.
+    """
+    spots = []
+
+    for i in range(rm.getCount()):
+        roi = rm.getRoi(i)
+        z = roi.getZPosition()
+        if not roi.isLineOrPoint():
+            continue
+        points = roi.getContainedPoints()
+        if len(points) != 1:
+            continue
+        spots.append((i, int(points[0].x), int(points[0].y), z))
+    return spots
+
+
+def extractDistances(distMap, rm, threshold):
+    rt = measureDistances(distMap, spotsFromRoiManager(rm), threshold)
     rt.show("distances-" + distMap.getTitle().replace("3-iso-mask-", ""))
 
 
@@ -94,8 +212,7 @@ def updateControl(control, distMap):
     """
     Updates the control image with the distance map.
     """
-    dp = Duplicator()
-    mask8 = dp.run(control, 1, 1, 1, control.getNSlices(), 1, 1)
+    mask8 = channelView(control, 1)
     mask32 = ImagePlus(mask8.getTitle()+"-32", mask8.getStack().convertToFloat())
     imOut = RGBStackMerge.mergeChannels([mask32, distMap], True)
     imOut.setCalibration(control.getCalibration())
@@ -140,7 +257,18 @@ def main():
     removeInvalidSpots(ppt)
 
     imName  = control.getTitle()
-    distMap = distanceTransform(control)
+    options = getOptions() or {}
+    if options.get('exportEngine', "map") == "surface":
+        rt = measureSurfaceDistances(control, spotsFromRoiManager(rm), distThreshold)
+        rt.show("distances-" + imName.replace("3-iso-mask-", ""))
+        control.show()
+        return 0
+
+    upstream = control.getProperty("cache-key")
+    key = None
+    if options.get('useCache', False) and (upstream is not None):
+        key = stageKey('distances', {}, upstream)
+    distMap = cachedProduct(key, lambda: distanceTransform(control), CROP_PROPERTIES)
     distMap.setTitle(imName)
     extractDistances(distMap, rm, distThreshold)
     control = updateControl(control, distMap)
@@ -1,42 +1,45 @@
 from ij import IJ
 from ij.measure import ResultsTable
 import os
-from spots_to_membrane.spotsToMembrane import getTargetPath
+from spots_to_membrane.spotsToMembrane import getTargetPath, getSpotsPath, readSpots, getCropBounds
+from spots_to_membrane.spotsMapping import invertZ
 
 
 def loadPoints(pointsPath, imIn):
     """
     Load points from a CSV file and invert the Y and Z axes.
     Coordinates are in calibrated units here.
+    The Z axis is inverted as on the default isotropic grid (see 'isotropicZMapping'), so the positions don't depend on the resampling of the mask.
+    If the image is a crop of the original image, the points are expressed relative to the crop.
     """
     factor = imIn.getProperty("anisotropy-factor")
     if factor is None:
         raise ValueError("Anisotropy factor not found in the image properties.")
     
     factor = float(factor)
-    descr  = open(pointsPath, 'r')
-    
-    # Skip lines corresponding to useless data from Imaris.
-    for _ in range(4): 
-        descr.readline()
-    
     calibration = imIn.getCalibration()
-    Z = calibration.pixelDepth * imIn.getNSlices() # Total depth of the stack
+    mapping = imIn.getProperty("z-mapping")
+    if mapping is not None:
+        Z, padding = [float(v) for v in str(mapping).split(',')]
+    else: # Masks produced before the property existed.
+        Z = calibration.pixelDepth * imIn.getNSlices() # Total depth of the stack
+        padding = calibration.pixelDepth / factor
     Y = calibration.pixelHeight * imIn.getHeight() # Total height (and width) of the stack.
+    X0, Y0 = 0.0, 0.0
+    bounds = getCropBounds(imIn)
+    if bounds is not None:
+        X0, Y0 = bounds[0], bounds[1]
+        Y = float(imIn.getProperty("full-height"))
 
     buffer = []
-    while True:
-        line = descr.readline()
-        if len(line) == 0:
-            break
-        vals = [float(f) for f in line.split(',')[0:3]] # X, Y, Z coords
-        vals[1] = Y - vals[1] # Inverting Y axis
-        vals[2] = Z - vals[2] + (calibration.pixelDepth / factor) # Invert Z axis + accounting for the padding
+    for vals in readSpots(pointsPath):
+        vals[0] = vals[0] - X0
+        vals[1] = Y - vals[1] - Y0 # Inverting Y axis
+        vals[2] = invertZ(vals[2], Z, padding) # Invert Z axis + accounting for the padding
         buffer.append(vals)
-    descr.close()
 
     IJ.log("     | Found " + str(len(buffer)) + " spots.")
-    IJ.log("     | Starting Z: " + str(calibration.pixelDepth / factor))
+    IJ.log("     | Starting Z: " + str(padding))
     
     return sorted(buffer, key=lambda x: x[2]) # Points sorted by Z axis
 
@@ -52,37 +55,14 @@ def uncalibrate(points, imIn):
     return [(int(x/sx), int((y/sy)), int(z/sz)+1) for (x, y, z) in points]
 
 
-def getSpotsPath(imgPath):
+def makeTableFromPoints(points, uncalibrated, t=None):
     """
-    Attempt to find the spots file.
-    It can be located either in the same folder as the image or in a subfolder of which the name starts with "spots".
-
-    Args:
-        imgPath (str): The path to the image.
-
-    Returns:
-        str: The path to the spots file. None if no spots file is found.
+    Fills a table with the calibrated (X, Y, Z) and uncalibrated (pX, pY, pZ) coordinates of the spots.
+    If no table is provided, the 'Results' table is reset, filled and displayed.
     """
-    imgName = os.path.basename(imgPath)
-    imgDir  = os.path.dirname(imgPath)
-    spotsL  = [f for f in os.listdir(imgDir) if f.lower().startswith("spots") and os.path.isdir(os.path.join(imgDir, f))]
-    spotsN  = None if len(spotsL) == 0 else spotsL[0]
-    noExt   = ".".join(imgName.split('.')[:-1])
-
-    if spotsN is not None:
-        IJ.log("     | Found spots in a subfolder.")
-        spotsDir = os.path.join(imgDir, spotsN)
-    else:
-        IJ.log("     | Found spots in the same folder.")
-        spotsDir = imgDir
-    
-    targetL  = [f for f in os.listdir(spotsDir) if f.startswith(noExt) and f.lower().endswith('.csv')]
-    IJ.log("     | Found spots file: " + str(targetL) + ".")
-    return None if len(targetL) == 0 else os.path.join(spotsDir, targetL[0])
-
-
-def makeTableFromPoints(points, uncalibrated):
-    t = ResultsTable.getResultsTable()
+    show = t is None
+    if show:
+        t = ResultsTable.getResultsTable()
     t.reset()
 
     for index in range(len(points)):
@@ -93,39 +73,56 @@ def makeTableFromPoints(points, uncalibrated):
         t.setValue('pX', index, uncalibrated[index][0])
         t.setValue('pY', index, uncalibrated[index][1])
         t.setValue('pZ', index, uncalibrated[index][2])
-        t.updateResults()
+        if show:
+            t.updateResults()
     
-    t.show("Results")
+    if show:
+        t.show("Results")
     return t
 
 
-def main():
-
-    IJ.log("=======  Starting spots extraction  ========")
-
-    imIn = IJ.getImage()
-    imgPath = getTargetPath()
+def importSpots(imIn, imgPath, t=None):
+    """
+    Finds the spots file associated with the original image and loads its coordinates into a table.
 
-    if not os.path.isfile(imgPath):
-        IJ.log("Couldn't find the target image.")
-        return 1
+    Args:
+        imIn (ImagePlus): The isotropic mask produced by the rough segmentation.
+        imgPath (str): The path of the original image.
+        t (ResultsTable): The table to fill. If None, the 'Results' table is used and displayed.
 
+    Returns:
+        ResultsTable: The table containing the spots. None if no spots file was found.
+    """
     pointsPath = getSpotsPath(imgPath)
 
     if pointsPath is None:
         IJ.log("Couldn't find the spots for current image.")
-        return 1
+        return None
     
     IJ.log("  > Loading spots from: " + pointsPath)
     IJ.log("  > Filling results table with coordinates.")
 
     raw_points = loadPoints(pointsPath, imIn)
     points     = uncalibrate(raw_points, imIn)
-    _ = makeTableFromPoints(raw_points, points)
+    return makeTableFromPoints(raw_points, points, t)
+
+
+def main():
+
+    IJ.log("=======  Starting spots extraction  ========")
+
+    imIn = IJ.getImage()
+    imgPath = getTargetPath()
+
+    if not os.path.isfile(imgPath):
+        IJ.log("Couldn't find the target image.")
+        return 1
+
+    if importSpots(imIn, imgPath) is None:
+        return 1
 
     IJ.log("==> Spots import DONE.")
     return 0
 
-
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -2,92 +2,40 @@ import os, json
 from random import shuffle
 from ij import IJ, ImageStack, ImagePlus
 from ij.plugin.filter import BackgroundSubtracter
-from ij.plugin import GaussianBlur3D, Duplicator, ContrastEnhancer, RGBStackMerge, Concatenator, ChannelSplitter
-from ij.process import StackStatistics, ShortProcessor
-from ij.gui import WaitForUserDialog
-from spots_to_membrane.spotsToMembrane import getOptions, padStack, sandwichPad, updateTargetImage
+from ij.plugin import GaussianBlur3D, ContrastEnhancer, RGBStackMerge, ZProjector
+from ij.process import StackStatistics
+from ij.gui import Roi
+from spots_to_membrane.spotsToMembrane import getOptions, sandwichPad, channelView, updateTargetImage, mapSlices, parallelMap, assembleTrainingSet, openLazily, readSources, fileHash, sourceHash, stageKey, cachedProduct, getSpotsPath, cropToSpots, cropRoi, transferCrop, CROP_PROPERTIES, readChannels
 
 
-def gamma_correction(imIn, gamma=0.3333):
+def combine(images):
     """
-    Applies a gamma correction to a whole stack, slice by slice.
-    The original image is modified.
-
-    Args:
-        imIn (ImagePlus): The image to process.
-        gamma (float): The gamma value to apply.
-    """
-    for s in range(1, imIn.getNSlices()+1):
-        imIn.setSlice(s)
-        prc = imIn.getProcessor()
-        prc.gamma(gamma)
-
-
-def combine(imIn1, imIn2):
-    """
-    Combines two images into a multi-channel image.
+    Combines single-channel images into a multi-channel image.
     The calibration is taken from the first image.
-    The title is taken from the first image and the word "spots" is replaced by "preprocessed".
     Input images are closed.
 
     Args:
-        imIn1 (ImagePlus): The first image (future C1).
-        imIn2 (ImagePlus): The second image (future C2).
+        images (list): The images, in the order of the future channels (C1, C2, ...).
     
     Returns:
         ImagePlus: A newly created multi-channel image.
     """
-    if imIn1.getNSlices() != imIn2.getNSlices():
-        raise ValueError("Images must have the same number of slices.")
-    if imIn1.getNFrames() != imIn2.getNFrames():
-        raise ValueError("Images must have the same number of frames.")
-    if imIn1.getNChannels() != 1:
-        raise ValueError("Images must have only one channel. (not the case of the first image)")
-    if imIn2.getNChannels() != 1:
-        raise ValueError("Images must have only one channel. (not the case of the second image)")
+    for i, imIn in enumerate(images):
+        if imIn.getNSlices() != images[0].getNSlices():
+            raise ValueError("Images must have the same number of slices.")
+        if imIn.getNFrames() != images[0].getNFrames():
+            raise ValueError("Images must have the same number of frames.")
+        if imIn.getNChannels() != 1:
+            raise ValueError("Images must have only one channel. (not the case of the image " + str(i+1) + ")")
     
-    calib = imIn1.getCalibration()
-    imOut = RGBStackMerge.mergeChannels([imIn1, imIn2], False)
+    calib = images[0].getCalibration()
+    imOut = RGBStackMerge.mergeChannels(images, False)
     imOut.setCalibration(calib)
-    imIn1.close()
-    imIn2.close()
+    for imIn in images:
+        imIn.close()
     return imOut
 
 
-def rollingBallBG(imIn, radius=20.0):
-    """
-    Applies a rolling ball background subtraction to the image, slice by slice.
-    The original image is modified.
-
-    Args:
-        imIn (ImagePlus): The image to process.
-        radius (float): The radius of the rolling ball (in calibrated pixels).
-    """
-    bs = BackgroundSubtracter()
-    for s in range(1, imIn.getNSlices()+1):
-        imIn.setSlice(s)
-        prc = imIn.getProcessor()
-        bs.rollingBallBackground(prc, radius, False, False, True, True, True)
-
-
-def stretchHistogram(imIn, eq):
-    """
-    Stretches the histogram of the image, slice by slice, according to the stack histogram.
-    The original image is modified.
-
-    Args:
-        imIn (ImagePlus): The image to process.
-        eq (bool): If True, the image is equalized after the stretching.
-    """
-    ce = ContrastEnhancer()
-    ce.setNormalize(True)
-    ce.setProcessStack(True)
-    ce.setUseStackHistogram(True)
-    ce.stretchHistogram(imIn, 0.35)
-    if eq:
-        ce.equalize(imIn)
-
-
 def gaussianBlur3D(imIn, basis):
     """
     Tries to remove some noise with a gaussian blur.
@@ -103,42 +51,119 @@ def gaussianBlur3D(imIn, basis):
     GaussianBlur3D.blur(imIn, basis, basis, z_factor*basis)
 
 
-def preprocessChannel(imIn, blur, gamma, eq=False):
+def preprocessChannel(imIn, blur, eq=False, radius=20.0):
+    """
+    First part of the cleaning of a channel: background correction, values range and denoising.
+    The slices are processed directly in the stack, and each pass does as much work as possible:
+        - Pass 1: rolling ball background subtraction.
+        - The stack histogram is computed once.
+        - Pass 2: the histogram is stretched (and normalized) according to the stack histogram, and equalized.
+        - The 3D gaussian blur is the only step requiring the neighbour slices.
+    The original image is modified.
+
+    Args:
+        imIn (ImagePlus): The image to process.
+        blur (float): The basis for the sigma of the gaussian blur.
+        eq (bool): If True, each slice is equalized after the stretching.
+        radius (float): The radius of the rolling ball (in calibrated pixels).
+    """
+    stack = imIn.getStack()
     # Subtract BG
-    rollingBallBG(imIn)
+    def subtractBackground(prc):
+        BackgroundSubtracter().rollingBallBackground(prc, radius, False, False, True, True, True)
+    mapSlices(stack, subtractBackground)
     IJ.log("     | Background correction done.")
     # Enhance contrast + equalize + normalize
-    stretchHistogram(imIn, eq)
+    stats = StackStatistics(imIn)
+    def fixRange(prc):
+        ce = ContrastEnhancer()
+        ce.setNormalize(True)
+        ce.stretchHistogram(prc, 0.35, stats)
+        if eq:
+            ce.equalize(prc)
+    mapSlices(stack, fixRange)
     IJ.log("     | Values range fixed.")
     # Bluring to catch info around
     gaussianBlur3D(imIn, blur)
     IJ.log("     | Denoising done.")
-    # Gamma correction
-    gamma_correction(imIn, gamma)
-    IJ.log("     | Gamma correction done.")
-    # Adding black slices
-    imOut = sandwichPad(imIn)
-    IJ.log("     | Padding done.")
-    return imOut
 
 
-def removeBackground(imIn, roi):
+def finalizeChannel(imIn, gamma, roi):
     """
-    Uses the maximal value found in an ROI to remove the background slice per slice.
-    This is particularly useful when the background is not consistent from one slice to another.
-    This is a simple background removal by value subtraction.
+    Last part of the cleaning of a channel, done in a single pass over the slices:
+        - Gamma correction, relative to the display range of the image.
+        - Removal of the background, using the maximal value found in an ROI, slice per slice.
+          This is particularly useful when the background is not consistent from one slice to another.
+        - Padding: a black slice is added at the beginning and at the end of the stack, without copying the other slices.
+    The original image is closed, the returned image is a new instance sharing its pixels.
+
+    Args:
+        imIn (ImagePlus): The image to process.
+        gamma (float): The gamma value to apply.
+        roi (Roi): An ROI in an empty area.
+
+    Returns:
+        ImagePlus: The padded image.
     """
-    imIn.resetRoi()
-    removed = []
-    for s in range(1, imIn.getNSlices()+1):
-        imIn.setSlice(s)
-        prc = imIn.getProcessor()
+    stack  = imIn.getStack()
+    # Like the 'Gamma...' command, the gamma is applied relative to the display range of the image, not of each slice.
+    low, high = imIn.getDisplayRangeMin(), imIn.getDisplayRangeMax()
+    def gammaAndBackground(prc):
+        if gamma != 1.0:
+            prc.setMinAndMax(low, high)
+            prc.gamma(gamma)
         prc.setRoi(roi)
         bg = prc.getStatistics().max
-        removed.append(bg)
         prc.resetRoi()
         prc.subtract(bg)
+        return bg
+    removed = [0.0] + mapSlices(stack, gammaAndBackground) + [0.0]
     IJ.log("  > Background removed: " + str(removed))
+    return sandwichPad(imIn)
+
+
+def estimateBackgroundRoi(imSpots, imMembrane, tileSize=64):
+    """
+    Replaces the ROI drawn by the user in an empty area.
+    The image is divided in square tiles, and the tile whose brightest voxel (over the whole stack) is the darkest is chosen.
+    Such a tile contains no spot on any slice, which is what is expected from the ROI.
+    It can be estimated before the gamma correction as it is a monotonic transform of each slice.
+    The maximal projection of each channel is computed, so the stacks are only read once.
+    Tiles that are completely black (ex: borders of a stitched image) are ignored.
+
+    Args:
+        imSpots (ImagePlus): The cleaned spots channel. Used to find a tile without spots.
+        imMembrane (ImagePlus): The cleaned membrane channel. Used to break ties.
+        tileSize (int): The side (in pixels) of the tiles.
+
+    Returns:
+        Roi: A rectangular ROI covering the chosen tile.
+    """
+    projections = []
+    for imIn in [imSpots, imMembrane]:
+        zp = ZProjector(imIn)
+        zp.setMethod(ZProjector.MAX_METHOD)
+        zp.doProjection()
+        projections.append(zp.getProjection().getProcessor())
+    
+    tileSize = min(tileSize, imSpots.getWidth(), imSpots.getHeight())
+    best = None
+    for y in range(0, imSpots.getHeight() - tileSize + 1, tileSize):
+        for x in range(0, imSpots.getWidth() - tileSize + 1, tileSize):
+            score = []
+            for prc in projections:
+                prc.setRoi(x, y, tileSize, tileSize)
+                score.append(prc.getStatistics().max)
+            if score[0] <= 0:
+                continue
+            if (best is None) or (score < best[0]):
+                best = (score, x, y)
+    
+    if best is None:
+        raise ValueError("No tile could be used to estimate the background.")
+    score, x, y = best
+    IJ.log("  > Background ROI estimated: " + str((x, y, tileSize, tileSize)) + ", max values: " + str(score))
+    return Roi(x, y, tileSize, tileSize)
 
 
 def convertToIntegers(imIn):
@@ -159,131 +184,238 @@ def convertToIntegers(imIn):
         raise ValueError("Can't handle RGB images.")
     
     ss = StackStatistics(imIn)
+    def toShort(prc):
+        # Scaling through the display range leaves the input untouched.
+        prc.setMinAndMax(ss.min, ss.max)
+        return prc.convertToShort(True)
     st = ImageStack(imIn.getWidth(), imIn.getHeight())
-    for i in range(1, imIn.getNSlices()+1):
-        imIn.setSlice(i)
-        prc = imIn.getProcessor()
-        prc.subtract(ss.min)
-        prc.multiply(1.0/(ss.max - ss.min))
-        prc.multiply(65535.0)
-        st.addSlice(prc.convertToShort(False))
+    for prc in mapSlices(imIn.getStack(), toShort):
+        st.addSlice(prc)
     
     imOut = ImagePlus(imIn.getTitle(), st)
     imIn.close()
     return imOut
     
 
-def preprocessImage(imIn, options):
+def preprocessImage(imIn, options, roi=None, inPlace=False):
     """
     Produces an image as it is expected by the random-forest classifier.
     The input image is kept opened as it was opened by the user.
+    Unless 'inPlace' is True, the input image is not modified. Otherwise, its pixels are reused to avoid any copy.
     The process is based on the 'dense spots' and the membrane channels.
+    Channels listed in the 'chExtra' option are processed like the membrane and added after it.
+    The channels don't share anything until the background removal, so they are processed simultaneously.
     The result is padded with black slices to avoid errors when applying the distance transform.
+    If no background ROI is provided, the one of the image is used, and it is estimated automatically if there is none.
     """
-    dp         = Duplicator()
-    chSpots    = dp.run(imIn, options['chSpots'], options['chSpots'], 1, imIn.getNSlices(), 1, 1)
-    chMembrane = dp.run(imIn, options['chMembrane'], options['chMembrane'], 1, imIn.getNSlices(), 1, 1)
+    # (channel index, equalize, gamma)
+    settings = [(options['chSpots'], True, 0.25), (options['chMembrane'], False, 1.0)]
+    settings += [(c, False, 1.0) for c in options.get('chExtra', [])]
+
+    channels = [channelView(imIn, c) for c, _, _ in settings]
 
     blur = 1.0
-    roi = imIn.getRoi()
     if roi is None:
-        wfs = WaitForUserDialog("ROI required", "Draw an ROI in an empty area.")
-        wfs.show()
         roi = imIn.getRoi()
 
+    def clean(i):
+        c, eq, _ = settings[i]
+        IJ.log("  > Converting and cleaning channel " + str(c))
+        imCh = convertToIntegers(channels[i])
+        if (imCh is channels[i]) and not inPlace: # The view must be copied before being modified.
+            imCh = ImagePlus(imCh.getTitle(), imCh.getStack().duplicate())
+            imCh.setCalibration(imIn.getCalibration())
+        preprocessChannel(imCh, blur, eq)
+        IJ.log("  > Channel " + str(c) + " cleaned")
+        return imCh
+    channels = parallelMap(clean, range(len(settings)), len(settings))
+
     if roi is None:
-        raise ValueError("ROI is required to remove the background.")
-    IJ.log("  > Converting first channel")
-    chSpots    = convertToIntegers(chSpots)
-    IJ.log("  > Converting second channel")
-    chMembrane = convertToIntegers(chMembrane)
-
-    IJ.log("  > Cleaning first channel")
-    chSpots    = preprocessChannel(chSpots, blur, 0.25, True)
-    IJ.log("  > Cleaning second channel")
-    chMembrane = preprocessChannel(chMembrane, blur, 1.0, False)
-
-    IJ.log("  > Removing background in first channel")
-    removeBackground(chSpots, roi)
-    IJ.log("  > Removing background in second channel")
-    removeBackground(chMembrane, roi)
+        roi = estimateBackgroundRoi(channels[0], channels[1])
+
+    def finalize(i):
+        c, _, gamma = settings[i]
+        IJ.log("  > Removing background in channel " + str(c))
+        return finalizeChannel(channels[i], gamma, roi)
+    channels = parallelMap(finalize, range(len(settings)), len(settings))
     
-    imOut = combine(chSpots, chMembrane)
+    imOut = combine(channels)
     return imOut
 
 
-def msi(stacksInfo):
+def readForPreprocessing(path, options):
     """
-    Returns the maximal stack info.
+    Reads from the disk only the channels used by the preprocessing.
+
+    Args:
+        path (str): The path of the original image.
+        options (dict): The options, giving the indices of the channels.
+
+    Returns:
+        (ImagePlus, dict): The image containing the used channels, and a copy of the options with the indices of the channels in this image.
     """
-    maxStack = 0
-    maxPos = 0
-    for i, s in enumerate(stacksInfo):
-        if s[1] > maxStack:
-            maxStack = s[1]
-            maxPos = i
-    return maxPos
+    channels = [options['chSpots'], options['chMembrane']] + list(options.get('chExtra', []))
+    imIn  = readChannels(path, channels)
+    local = dict(options)
+    local.update({'chSpots': 1, 'chMembrane': 2, 'chExtra': list(range(3, len(channels)+1))})
+    return imIn, local
 
 
-def make_training_set(percents=0.6):
-    path = IJ.getFilePath("Select a 'sources.txt' file")
-    out_path = IJ.getDirectory("Select a folder to save the training set")
-    IJ.run("Close All")
-    files_list = [os.path.join(out_path, f) for f in os.listdir(out_path) if f.endswith('.tif')]
+_TRAINING_OPTIONS = {
+    'chSpots': 1,
+    'chMembrane': 3,
+    'sizeHoles': 2000
+}
+
+
+def loadTrainingManifest(manifestPath):
+    """
+    Reads the manifest describing the content of a training set.
+    It contains:
+        - 'frames' (list): The paths of the preprocessed images, in the order of the frames of the training set.
+        - 'sources' (dict): For each source image, its content hash (and the size and modification time it was computed for), the parameters used to preprocess it and the produced image.
+          Sources that were not picked when the set was created are recorded with a None product, so they are not added later.
+        - 'depth' (int): The number of slices of the frames, fixed when the set is created. Missing for sets created before it existed.
+
+    Args:
+        manifestPath (str): The path of the JSON manifest.
+
+    Returns:
+        dict: The manifest, empty if the file doesn't exist yet.
+    """
+    if not os.path.isfile(manifestPath):
+        return {'frames': [], 'sources': {}}
+    with open(manifestPath, 'r') as f:
+        return json.load(f)
+
+
+def saveTrainingManifest(manifestPath, manifest):
+    with open(manifestPath, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def preprocessSource(source, outPath, options, maxDepth=None):
+    """
+    Preprocesses an image of the training set and saves the result in the output folder.
 
-    if len(files_list) == 0:
-        descr = open(path, 'r')
-        content = [c for c in descr.read().split('\n') if len(c) > 1 and c.strip()[0] != "#"]
-        descr.close()
+    Args:
+        source (str): The path of the source image.
+        outPath (str): The folder in which the preprocessed image is saved.
+        options (dict): The options used to preprocess the image.
+        maxDepth (int): The maximal number of slices of the result. If it is exceeded, nothing is saved.
+
+    Returns:
+        str: The path of the preprocessed image. None if it was too deep.
+    """
+    imIn, local = readForPreprocessing(source, options)
+    imOut = preprocessImage(imIn, local, None, True)
+    imOut.setTitle(imIn.getTitle())
+    imOut.setCalibration(imIn.getCalibration())
+    imIn.close()
+    if (maxDepth is not None) and (imOut.getNSlices() > maxDepth):
+        IJ.log("  > Skipped: " + str(imOut.getNSlices()) + " slices, the frames of the training set have " + str(maxDepth) + ".")
+        imOut.close()
+        return None
+    prod = os.path.join(outPath, imOut.getTitle()+".tif")
+    IJ.saveAs(imOut, "Tiff", prod)
+    imOut.close()
+    return prod
+
+
+def updateTrainingSet(sourcesPath, outPath, percents, options):
+    """
+    Creates or updates the training set located in 'outPath' from the images listed in 'sources.txt'.
+    A manifest ('training-set.json') keeps track of the sources already included, so only new or modified sources are preprocessed:
+        - On the first run, a random subset of the sources is picked.
+        - Sources that are new to the manifest are all added, as new frames at the end of the training set.
+        - Sources whose content or preprocessing parameters changed are preprocessed again and keep their frame.
+    A source is only hashed again when its size or modification time changed, so checking an up-to-date set doesn't read the images.
+    The order of the existing frames and their depth never change, so the annotations made in LabKit stay valid:
+    the depth is fixed when the set is created, and sources that would be deeper once preprocessed are refused (they are left out of the set).
+
+    Args:
+        sourcesPath (str): The path of the 'sources.txt' file.
+        outPath (str): The folder containing the training set.
+        percents (float): The fraction of the sources picked on the first run.
+        options (dict): The options used to preprocess the images.
+    """
+    manifestPath = os.path.join(outPath, "training-set.json")
+    tsPath       = os.path.join(outPath, "training-set.tif")
+    manifest     = loadTrainingManifest(manifestPath)
+
+    content = [c for c in readSources(sourcesPath) if c not in manifest['sources']]
+    if len(manifest['frames']) == 0:
         shuffle(content)
+        for c in content[int(len(content)*percents):]:
+            manifest['sources'][c] = {'hash': None, 'parameters': None, 'product': None}
         content = content[:int(len(content)*percents)]
-        produced = []
+    for c in content:
+        manifest['sources'][c] = {'hash': None, 'stamp': None, 'parameters': None, 'product': ""}
+
+    todo = []
+    for source, entry in manifest['sources'].items():
+        if entry['product'] is None:
+            continue
+        if not os.path.isfile(source):
+            IJ.log("File not found: " + source)
+            continue
+        # The content is only hashed again if the size or the modification time changed.
+        stamp  = [os.path.getsize(source), os.path.getmtime(source)]
+        digest = entry['hash'] if entry.get('stamp') == stamp else fileHash(source)
+        if (digest != entry['hash']) or (entry['parameters'] != options) or not os.path.isfile(entry['product']):
+            todo.append((source, digest, stamp))
+        elif entry.get('stamp') != stamp: # Touched but not modified.
+            entry['stamp'] = stamp
+            saveTrainingManifest(manifestPath, manifest)
+
+    if len(todo) == 0 and os.path.isfile(tsPath):
+        IJ.log("Training set already up to date.")
+        return
+
+    # Sets assembled before the depth was stored keep the depth they were assembled with.
+    if (manifest.get('depth') is None) and os.path.isfile(tsPath):
+        for frame in [f for f in manifest['frames'] if os.path.isfile(f)]:
+            imp = openLazily(frame)
+            manifest['depth'] = max(manifest.get('depth') or 0, imp.getNSlices())
+            imp.close()
+
+    changed = False
+    for i, (source, digest, stamp) in enumerate(todo):
+        IJ.log("Processing " + os.path.basename(source) + " (" + str(i+1) + "/" + str(len(todo)) + ")")
+        prod = preprocessSource(source, outPath, options, manifest.get('depth'))
+        if prod is None:
+            IJ.log("  > WARNING: " + os.path.basename(source) + " is deeper than the training set, it is not added (the existing labelings would break).")
+            continue
+        changed = True
+        entry = manifest['sources'][source]
+        if entry['product'] in manifest['frames']:
+            manifest['frames'][manifest['frames'].index(entry['product'])] = prod
+        else:
+            manifest['frames'].append(prod)
+        entry.update({'hash': digest, 'stamp': stamp, 'parameters': options, 'product': prod})
+        # Saved after each image, so an interruption doesn't lose the work already done.
+        saveTrainingManifest(manifestPath, manifest)
+
+    if not changed and os.path.isfile(tsPath):
+        IJ.log("Training set unchanged.")
+        return
+    IJ.log("Processing done. Assembling...")
+    manifest['depth'] = assembleTrainingSet(manifest['frames'], tsPath, manifest.get('depth'))
+    saveTrainingManifest(manifestPath, manifest)
 
-        for i, c in enumerate(content):
-            if c == "":
-                continue
-            if not os.path.isfile(c):
-                IJ.log("File not found: " + c)
-                continue
-            imIn = IJ.openImage(c)
-            imIn.show()
-
-            IJ.log("Processing " + imIn.getTitle() + " (" + str(i+1) + "/" + str(len(content)) + ")")
-            
-            imOut = preprocessImage(imIn, {
-                'chSpots': 1,
-                'chMembrane': 3,
-                'sizeHoles': 2000
-            })
-
-            imOut.setTitle(imIn.getTitle())
-            imOut.setCalibration(imIn.getCalibration())
-            imIn.close()
-            prod = os.path.join(out_path, imOut.getTitle()+".tif")
-            IJ.saveAs(imOut, "Tiff", prod)
-            produced.append(prod)
-            imOut.close()
-    else:
-        produced = [p for p in files_list if os.path.isfile(p)]
 
-    IJ.log("Processing done. Assembling...")
-    IJ.run("Close All")
-    production = [IJ.openImage(p) for p in produced]
-    stacksInfo = [(p.getTitle(), p.getNSlices()) for p in production]
-
-    i = msi(stacksInfo)
-    maxStack = stacksInfo[i][1]
-    maxTitle = stacksInfo[i][0]
-    IJ.log("Biggest stack: " + str(maxStack) + " for: " + maxTitle)
-
-    calib = production[0].getCalibration()
-    padded = [padStack(p, maxStack) for p in production]
-    ts = Concatenator().concatenate(padded, False)
-    ts.setCalibration(calib)
-    ts.setDimensions(2, maxStack, len(padded))
-    ts.setTitle("training-set")
-    IJ.saveAs(ts, "Tiff", os.path.join(out_path, "training-set.tif"))
+def make_training_set(percents=0.6):
+    path = IJ.getFilePath("Select a 'sources.txt' file")
+    out_path = IJ.getDirectory("Select a folder to save the training set")
     IJ.run("Close All")
+    files_list = [os.path.join(out_path, f) for f in os.listdir(out_path) if f.endswith('.tif') and f != "training-set.tif"]
+
+    if len(files_list) > 0 and not os.path.isfile(os.path.join(out_path, "training-set.json")):
+        # Folder created before the manifest existed: we just re-assemble what it contains.
+        IJ.log("No manifest found. Assembling...")
+        assembleTrainingSet(files_list, os.path.join(out_path, "training-set.tif"))
+    else:
+        updateTrainingSet(path, out_path, percents, _TRAINING_OPTIONS)
     IJ.log("Training set done and saved.")
 
 
@@ -301,8 +433,30 @@ def main():
     options = getOptions()
     ppt = imIn.getProperty("invalid-spots-path")
 
+    # With a crop margin, only the region around the spots is processed.
+    spotsPath = None
+    if options.get('cropMargin') is not None:
+        spotsPath = getSpotsPath(path)
+        if spotsPath is None:
+            IJ.log("  > No spots found, the whole image is processed.")
+
+    # The cache is only used with rectangular ROIs, that can be described by their bounds.
     title = imIn.getTitle()
-    imOut = preprocessImage(imIn, options)
+    roi   = imIn.getRoi()
+    key   = None
+    if options.get('useCache', False) and ((roi is None) or (roi.getType() == Roi.RECTANGLE)):
+        bounds = None if roi is None else roi.getBounds()
+        options['backgroundRoi'] = None if bounds is None else [bounds.x, bounds.y, bounds.width, bounds.height]
+        key = stageKey('preprocess', options, sourceHash(path), None if spotsPath is None else sourceHash(spotsPath))
+
+    def preprocessed():
+        if spotsPath is None:
+            return preprocessImage(imIn, options)
+        imCrop = cropToSpots(imIn, spotsPath, options['cropMargin'])
+        imOut  = preprocessImage(imCrop, options, cropRoi(roi, imCrop), imCrop is not imIn)
+        transferCrop(imCrop, imOut)
+        return imOut
+    imOut = cachedProduct(key, preprocessed, CROP_PROPERTIES)
     imOut.setCalibration(clb)
     imOut.setProperty("invalid-spots-path", ppt)
     imOut.setTitle("1-preprocessed-" + title)
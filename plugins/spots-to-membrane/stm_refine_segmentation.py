@@ -1,89 +1,228 @@
+import math
 from ij import IJ, ImagePlus, ImageStack
-from ij.plugin import Duplicator, ImageCalculator, RGBStackMerge
+from ij import CompositeImage
+from ij.process import Blitter, ImageProcessor, ByteProcessor
 from inra.ijpb.label import LabelImages
-from inra.ijpb.plugins import AnalyzeRegions
+from inra.ijpb.binary.conncomp import FloodFillComponentsLabeling, FloodFillComponentsLabeling3D
 from ij.measure import ResultsTable
-from inra.ijpb.watershed import ExtendedMinimaWatershed
-from inra.ijpb.binary.distmap import ChamferMask3D
-from inra.ijpb.binary import BinaryImages
-from inra.ijpb.data.image import Images3D
+from inra.ijpb.watershed import ExtendedMinimaWatershed, Watershed
 from inra.ijpb.morphology import Strel3D
 from ij.gui import PointRoi, WaitForUserDialog
 from ij.plugin.frame import RoiManager
 
-from spots_to_membrane.spotsToMembrane import getOptions, sandwichPad, makeIsotropic, getTargetPath
+from spots_to_membrane.spotsToMembrane import getOptions, sandwichPad, makeIsotropic, getTargetPath, mapSlices, parallelMap, channelView, InterleavedStack, sampleStack, euclideanDistanceMap, labelsToMask, maskFromLabels, sourceHash, stageKey, cachedProduct, getSpotsPath, getCropBounds, cropImage, transferCrop, CROP_PROPERTIES, readChannels
 
 
-def fillHoles(imIn):
-    _dp = Duplicator()
-    ft = AnalyzeRegions.Features()
-    ft.setAll(False)
-    ft.area = True
+def fillHoles(imIn, minSize):
+    """
+    Fills the holes smaller than 'minSize' pixels in each slice of a mask.
+    Each slice is processed in a single pass, and the slices are processed in parallel:
+        - The background components are labeled (4-connectivity).
+        - Their area is read from the histogram of the labels.
+        - Small components are turned into a mask with a lookup table, merged with the original slice.
+
+    Args:
+        imIn (ImagePlus): The mask. It is not modified.
+        minSize (int): Holes with an area (in pixels) strictly below this value are filled.
+
+    Returns:
+        ImagePlus: The new mask, without small holes.
+    """
+    def fillSlice(prc):
+        mask = prc.convertToByte(False).duplicate()
+        background = mask.duplicate()
+        background.invert()
+        labels = FloodFillComponentsLabeling(4, 16).computeLabels(background)
+        labels.resetMinAndMax()
+        hist = labels.getHistogram()
+        small = [l for l in range(1, int(labels.getMax())+1) if 0 < hist[l] < minSize]
+        filled = maskFromLabels(labels, small) # Local table, each slice has its own labels.
+        filled.copyBits(mask, 0, 0, Blitter.MAX)
+        return filled
+
+    stack = ImageStack(imIn.getWidth(), imIn.getHeight())
+    for mask in mapSlices(imIn.getStack(), fillSlice):
+        stack.addSlice(mask)
+
+    imOut = ImagePlus("Filled", stack)
+    imOut.setCalibration(imIn.getCalibration())
+    IJ.log("     | Holes of size < " + str(minSize) + " pixels removed on each slice.")
+    return imOut
 
-    buffer = ImageStack(imIn.getWidth(), imIn.getHeight())
-    cb = imIn.getCalibration()
-    options = getOptions()
-    min_size = options['sizeHoles']
 
-    for s in range(1, imIn.getNSlices()+1):
-        imWork = _dp.run(imIn, 1, 1, s, s, 1, 1)
-        prc = imWork.getProcessor()
+def fillHoles3D(imIn, minSize):
+    """
+    Fills the holes smaller than 'minSize' voxels of a mask, in 3D.
+    Unlike 'fillHoles', a hole is only filled if it is closed in every direction (6-connectivity).
+
+    Args:
+        imIn (ImagePlus): The mask. It is not modified.
+        minSize (int): Holes with a volume (in voxels) strictly below this value are filled.
+
+    Returns:
+        ImagePlus: The new mask, without small holes.
+    """
+    def inverted(prc):
+        prc = prc.convertToByte(False).duplicate()
         prc.invert()
-        imLbld = LabelImages.regionComponentsLabeling(imWork, 255, 4, 16)
-        imWork.close()
-        props = AnalyzeRegions.process(imLbld, ft)
-
-        keep = []
-        for i in range(props.size()):
-            if props.getValue('Area', i) < min_size:
-                keep.append(i+1)
-                continue
-            
-        holes = LabelImages.keepLabels(imLbld, keep)
-        imLbld.close()
-        prc2 = holes.getProcessor()
-        prc2.setThreshold(1, 65536)
-        buffer.addSlice(prc2.createMask())
-        holes.close()
-    
-    IJ.log("     | Holes map processed.")
-    imPatches = ImagePlus("Patches", buffer)
-    imOut = ImageCalculator().run("or stack create", imPatches, imIn)
-    imPatches.close()
-    imOut.setCalibration(cb)
-    IJ.log("     | Holes of size < " + str(min_size) + " pixels removed on each slice.")
+        return prc
+    background = ImageStack(imIn.getWidth(), imIn.getHeight())
+    for prc in mapSlices(imIn.getStack(), inverted):
+        background.addSlice(prc)
 
+    labels = FloodFillComponentsLabeling3D(6, 32).computeLabels(background)
+    ids = LabelImages.findAllLabels(labels)
+    counts = LabelImages.voxelCount(labels, ids)
+    small = [ids[i] for i in range(len(ids)) if counts[i] < minSize]
+    holes = LabelImages.keepLabels(labels, small)
+
+    source = imIn.getStack()
+    def merge(s):
+        prc = holes.getProcessor(s)
+        prc.setThreshold(1, 1e30, ImageProcessor.NO_LUT_UPDATE)
+        mask = prc.createMask()
+        mask.copyBits(source.getProcessor(s).convertToByte(False), 0, 0, Blitter.MAX)
+        return mask
+    stack = ImageStack(imIn.getWidth(), imIn.getHeight())
+    for mask in parallelMap(merge, range(1, source.getSize()+1)):
+        stack.addSlice(mask)
+
+    imOut = ImagePlus("Filled", stack)
+    imOut.setCalibration(imIn.getCalibration())
+    IJ.log("     | Holes of size < " + str(minSize) + " voxels removed in 3D.")
     return imOut
 
 
-def findMainCell(imIn, spots):
+def clusterSpots(locations, spacing, maxDist):
+    """
+    Groups the spots by proximity (single linkage): two spots closer than 'maxDist' are in the same cluster.
+    The spots are binned in a grid of cells of size 'maxDist', so each spot is only compared to the spots of the neighbouring cells.
+
+    Args:
+        locations (list): Tuples (x, y, z) in pixels, z being a slice index.
+        spacing (list): The size of a voxel along (X, Y, Z).
+        maxDist (float): The linkage distance, in the unit of 'spacing'. If not positive, each spot is its own cluster.
+
+    Returns:
+        list: The label (from 1) of the cluster of each spot, in the order of the locations.
+    """
+    points = [(x * spacing[0], y * spacing[1], z * spacing[2]) for x, y, z in locations]
+    parents = list(range(len(points)))
+
+    def root(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    if maxDist > 0:
+        cells = {}
+        for i, p in enumerate(points):
+            cells.setdefault(tuple(int(math.floor(c / maxDist)) for c in p), []).append(i)
+        for (cx, cy, cz), indices in cells.items():
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for dz in (-1, 0, 1):
+                        for j in cells.get((cx+dx, cy+dy, cz+dz), []):
+                            for i in indices:
+                                if i < j and sum((a-b)**2 for a, b in zip(points[i], points[j])) <= maxDist**2:
+                                    parents[root(j)] = root(i)
+
+    labels = {}
+    return [labels.setdefault(root(i), len(labels)+1) for i in range(len(points))]
+
+
+def spotsMarkers(imIn, locations, seedDistance, backgroundDistance):
+    """
+    Builds the markers of a watershed from the spots.
+    Each cluster of spots is a marker, and the voxels of the mask farther than 'backgroundDistance' from every spot make the background marker.
+
+    Args:
+        imIn (ImagePlus): The mask.
+        locations (list): Tuples (x, y, z) of the spots inside the mask, in pixels, z being a slice index.
+        seedDistance (float): Spots closer than this distance (in calibrated unit) are in the same marker.
+        backgroundDistance (float): The distance (in calibrated unit) from the spots beyond which the mask is background.
+
+    Returns:
+        (ImageStack, int): The markers (16 bits) and the number of clusters of spots, labeled from 1. The background marker is the next label.
+    """
+    cb = imIn.getCalibration()
+    spacing = [cb.pixelWidth, cb.pixelHeight, cb.pixelDepth]
+    labels = clusterSpots(locations, spacing, seedDistance)
+    nClusters = max(labels) if len(labels) > 0 else 0
+    stack = imIn.getStack()
+    w, h = stack.getWidth(), stack.getHeight()
+
+    # Distance of each voxel to the closest spot.
+    seeds = ImageStack(w, h)
+    for _ in range(stack.getSize()):
+        prc = ByteProcessor(w, h)
+        prc.setValue(255)
+        prc.fill()
+        seeds.addSlice(prc)
+    for x, y, z in locations:
+        seeds.getProcessor(z).set(x, y, 0)
+    distances = euclideanDistanceMap(seeds, spacing)
+
+    def background(s):
+        far = distances.getProcessor(s)
+        far.setThreshold(backgroundDistance, 1e30, ImageProcessor.NO_LUT_UPDATE)
+        prc = far.createMask()
+        prc.copyBits(stack.getProcessor(s), 0, 0, Blitter.AND)
+        prc = prc.convertToShortProcessor(False)
+        prc.multiply((nClusters + 1) / 255.0)
+        return prc
+
+    markers = ImageStack(w, h)
+    for prc in parallelMap(background, range(1, stack.getSize()+1)):
+        markers.addSlice(prc)
+    for (x, y, z), lbl in zip(locations, labels):
+        markers.getProcessor(z).set(x, y, lbl)
+
+    return markers, nClusters
+
+
+def findMainCell(imIn, spots, seeds="minima", seedDistance=1.0, backgroundDistance=10.0):
+    """
+    Splits touching elements of the mask, and keeps the fragments containing spots.
+    The watershed works on the inverted distance map, its markers can be:
+        - "minima": The extended minima of the whole map, the fragments containing spots being looked for afterwards.
+        - "spots": The clusters of spots, and a background marker far from them, so the flooding only separates the cell(s) of interest.
+
+    Args:
+        imIn (ImagePlus): The mask. It is closed.
+        spots (ResultsTable): The table of spots.
+        seeds (str): The markers of the watershed, "minima" or "spots".
+        seedDistance (float): With "spots", spots closer than this distance (in calibrated unit) are in the same marker.
+        backgroundDistance (float): With "spots", the voxels farther than this distance (in calibrated unit) from every spot are background.
+
+    Returns:
+        ImagePlus: The mask of the fragments containing spots, merged.
+    """
     # 1. Splitting touching elements.
-    kernel = ChamferMask3D.QUASI_EUCLIDEAN
-    distStack = BinaryImages.distanceMap(imIn.getStack(), kernel, False, True)
-    Images3D.invert(distStack)
-    res = ExtendedMinimaWatershed.extendedMinimaWatershed(distStack, imIn.getStack(), 4, 6, 16, False)
-    imSplit = ImagePlus("Split", res)
-    IJ.log("     | Chamfer distance and extrema-seeded watershed done.")
-    
-    # 2. Keeping and merging all regions containing spots.
-    keep = set()
-    for i in range(spots.size()):
-        s = int(spots.getValue("pZ", i))
-        y = int(spots.getValue("pY", i))
-        x = int(spots.getValue("pX", i))
-        imSplit.setSlice(s)
-        lbl = imSplit.getProcessor().get(x, y)
-        keep.add(lbl)
+    # Distances are expressed in XY pixels, whatever the Z step is.
+    cb = imIn.getCalibration()
+    distStack = euclideanDistanceMap(imIn.getStack(), [1.0, cb.pixelHeight / cb.pixelWidth, cb.pixelDepth / cb.pixelWidth])
+    mapSlices(distStack, lambda prc: prc.multiply(-1.0)) # Cell centers become minima.
+    locations = [(int(spots.getValue("pX", i)), int(spots.getValue("pY", i)), int(spots.getValue("pZ", i))) for i in range(spots.size())]
+
+    if seeds == "spots":
+        inside = [loc for loc, v in zip(locations, sampleStack(imIn.getStack(), locations)) if v > 0]
+        markers, nClusters = spotsMarkers(imIn, inside, seedDistance, backgroundDistance)
+        imSplit = Watershed.computeWatershed(ImagePlus("Distances", distStack), ImagePlus("Markers", markers), imIn, 6, False)
+        res = imSplit.getStack()
+        IJ.log("     | Euclidean distance and spots-seeded watershed done (" + str(nClusters) + " clusters of spots).")
+        keep = set(range(1, nClusters+1))
+    else:
+        res = ExtendedMinimaWatershed.extendedMinimaWatershed(distStack, imIn.getStack(), 4, 6, 16, False)
+        imSplit = ImagePlus("Split", res)
+        IJ.log("     | Euclidean distance and extrema-seeded watershed done.")
+        # 2. Keeping and merging all regions containing spots.
+        keep = set(int(lbl) for lbl in sampleStack(res, locations))
+        keep.discard(0) # Spots in the background.
     IJ.log("     | Fragments containing spots isolated.")
     
-    interest = LabelImages.keepLabels(imSplit, list(keep))
-    stackOut = ImageStack()
-
-    for s in range(1, interest.getNSlices()+1):
-        interest.setSlice(s)
-        prc = interest.getProcessor()
-        prc.setThreshold(1, 65535)
-        stackOut.addSlice(prc.createMask())
+    stackOut = labelsToMask(res, list(keep))
     
     strel = Strel3D.Shape.CUBE.fromRadius(2)
     closed = strel.closing(stackOut)
@@ -92,7 +231,7 @@ def findMainCell(imIn, spots):
     imOut = ImagePlus("Main cell", closed)
     imOut.setCalibration(imIn.getCalibration())
     imIn.close()
-    interest.close()
+    imSplit.close()
 
     return imOut
 
@@ -114,36 +253,74 @@ def spotsToROIManager(imIn, spots):
     IJ.log("     | Spots added to ROI Manager.")
 
 
-def makeControlImage(mask, imgPath):
+def makeControlImage(mask, imgPath, options=None):
     # Getting option to find the membrane channel.
-    options = getOptions()
+    if options is None:
+        options = getOptions()
     chIndex = options['chMembrane']
 
-    # Isolating and padding the membrane channel.
-    imOri      = IJ.openImage(imgPath)
-    dp         = Duplicator()
-    chMembrane = dp.run(imOri, chIndex, chIndex, 1, imOri.getNSlices(), 1, 1)
+    # Isolating and padding the membrane channel, the other channels are not read.
+    imOri      = readChannels(imgPath, [chIndex])
+    bounds     = getCropBounds(mask)
+    if bounds is not None: # The mask only covers the region around the spots.
+        cb     = imOri.getCalibration()
+        x, y   = int(round(bounds[0] / cb.pixelWidth)), int(round(bounds[1] / cb.pixelHeight))
+        w, h   = int(round(bounds[2] / cb.pixelWidth)), int(round(bounds[3] / cb.pixelHeight))
+        imCrop = cropImage(imOri, (x, y, w, h))
+        imOri.close()
+        imOri  = imCrop
+    chMembrane = channelView(imOri, 1)
     # k1 = chMembrane.duplicate()
     # k1.setTitle("P1")
     # k1.show()
     imOri.close()
     chMembrane = sandwichPad(chMembrane)
-    chMembrane, _ = makeIsotropic(chMembrane)
+    if options.get('isotropic', True):
+        chMembrane, _ = makeIsotropic(chMembrane, options.get('isoVoxelSize'))
     # k2 = chMembrane.duplicate()
     # k2.setTitle("P2")
     # k2.show()
 
-    # Assembling the control image.
-    control = RGBStackMerge.mergeChannels(
-        [mask, chMembrane], 
-        False
-    )
+    # Assembling the control image, without copying the channels.
+    stack = InterleavedStack([mask.getStack(), chMembrane.getStack()])
+    control = ImagePlus("control", stack)
+    control.setDimensions(2, mask.getNSlices(), 1)
+    control = CompositeImage(control, CompositeImage.COMPOSITE)
 
     IJ.log("     | Control image assembled.")
     control.setCalibration(mask.getCalibration())
+    transferCrop(mask, control)
     return control
         
 
+def refineSegmentation(imIn, spots, imgPath, useWatershed, options=None):
+    """
+    Fills the holes of the rough mask, optionally isolates the cell containing the spots, and builds the control image.
+    The control image contains the refined mask as first channel and the isotropic membrane channel as second channel.
+
+    Args:
+        imIn (ImagePlus): The isotropic rough mask.
+        spots (ResultsTable): The table of spots produced by the f3 stage.
+        imgPath (str): The path of the original image.
+        useWatershed (bool): Whether to split touching elements to keep only the cell(s) containing spots.
+        options (dict): The options. If None, they are read from 'options.json'.
+
+    Returns:
+        ImagePlus: The control image.
+    """
+    if options is None:
+        options = getOptions()
+    fill = fillHoles3D if options.get('holes3D', False) else fillHoles
+    mask = fill(imIn, options['sizeHoles'])
+    
+    if useWatershed:
+        IJ.log("  > Trying to isolate the main cell...")
+        mask = findMainCell(mask, spots, options.get('watershedSeeds', "minima"), options.get('seedDistance', 1.0), options.get('backgroundDistance', 10.0))
+    
+    transferCrop(imIn, mask)
+    return makeControlImage(mask, imgPath, options)
+
+
 def main():
     imIn = IJ.getImage()
     title = imIn.getTitle().replace("2-rough-mask-", "3-iso-mask-")
@@ -165,13 +342,14 @@ def main():
         IJ.log("No spots table found.")
         return 1
     
-    mask = fillHoles(imIn)
-    
-    if useWatershed:
-        IJ.log("  > Trying to isolate the main cell...")
-        mask = findMainCell(mask, spots)
-    
-    control = makeControlImage(mask, imgPath)
+    options   = getOptions()
+    upstream  = imIn.getProperty("cache-key")
+    spotsPath = getSpotsPath(imgPath)
+    key       = None
+    if (upstream is not None) and (options is not None) and options.get('useCache', False) and (spotsPath is not None):
+        options['useWatershed'] = useWatershed
+        key = stageKey('refine', options, upstream, sourceHash(spotsPath))
+    control = cachedProduct(key, lambda: refineSegmentation(imIn, spots, imgPath, useWatershed, options), CROP_PROPERTIES)
     spotsToROIManager(control, spots)
     IJ.selectWindow("Results")
     IJ.run("Close") 
@@ -1,76 +1,441 @@
+import os, json, math, hashlib, time
 from ij import IJ, ImagePlus, ImageStack
+from ij.process import ByteProcessor
+from java.lang import Throwable, Boolean
+from com.google.gson import JsonParser
 from net.imglib2.img import ImagePlusAdapter
 from sc.fiji.labkit.ui.segmentation import SegmentationTool
 from net.imglib2.img.display.imagej import ImageJFunctions
-from inra.ijpb.label.LabelImages import keepLabels
-from spots_to_membrane.spotsToMembrane import getClassifierPath, makeIsotropic
+from net.imglib2.img.array import ArrayImgs
+from net.imglib2.view import Views
+from net.imglib2 import FinalInterval
+from sc.fiji.labkit.pixel_classification.classification import Segmenter
+from sc.fiji.labkit.pixel_classification.random_forest import CpuRandomForestPrediction
+from org.janelia.saalfeldlab.n5 import N5FSWriter, GzipCompression
+from org.janelia.saalfeldlab.n5.imglib2 import N5Utils
+from spots_to_membrane.spotsMapping import isotropicZMapping
+from spots_to_membrane.spotsToMembrane import getOptions, getClassifierPath, makeIsotropic, stageKey, cachedProduct, getCacheDir, cacheEvict, cacheRecordSize, labelsToMask, maskFromLabels, labelsTable, transferCrop, CROP_PROPERTIES
 
+def getClassifierInfo(c_path):
+    """
+    Reads what the segmentation needs to know about the features of a classifier: the halo of the blocks and the signature of the features.
+    The classifier file is big, so it is only parsed once per version: the values are kept for the whole session, like the models.
 
-def main():
-    image = IJ.getImage()
-    ppt = image.getProperty("invalid-spots-path")
-    imgplus = ImagePlusAdapter.wrapImgPlus(image)
-    clb = image.getCalibration()
-    title = image.getTitle().replace("1-preprocessed-", "2-rough-mask-")
-    tryGPU = True
-    result = None
+    Args:
+        c_path (str): The path of the classifier file.
 
-    IJ.log("=======  Starting pixels classification  ========")
+    Returns:
+        (int, str): The halo (see 'getFeatureHalo') and the signature (see 'getFeaturesSignature').
+    """
+    stamp = [c_path, os.path.getmtime(c_path)]
+    known = IJ.getProperty("stm.classifier-info")
+    if (known is not None) and (list(known[0]) == stamp):
+        return known[1], known[2]
+    with open(c_path, 'r') as f:
+        features = json.load(f)['features']
+    halo      = int(math.ceil(4 * max(features['globals']['sigmas']))) + 2
+    signature = hashlib.md5(json.dumps(features, sort_keys=True)).hexdigest()
+    IJ.setProperty("stm.classifier-info", [stamp, halo, signature])
+    return halo, signature
+
+
+def getFeatureHalo(classifierPath):
+    """
+    Computes the margin needed around a tile so the features of the classifier are close to the ones of the whole image.
+    The Gaussian kernels are truncated at about ceil(3 sigma) + 1 pixels, and the derivative, Hessian and structure tensor
+    features add a few pixels of support on top of it. The halo is 4 times the biggest sigma plus 2 pixels, to cover both.
+    The features (and thus the mask) near the borders of the blocks can still differ slightly from a whole-image classification.
+
+    Args:
+        classifierPath (str): The path of the classifier file.
+
+    Returns:
+        int: The halo, in pixels.
+    """
+    return getClassifierInfo(classifierPath)[0]
+
+
+def getSegmentationTool(c_path, useGpu):
+    """
+    Provides a segmentation tool with the classifier loaded, for the requested backend.
+    The tools are kept for the whole session (in the properties of ImageJ) so the model is only loaded once.
+    It is loaded again if the classifier file changed (path or modification time).
+
+    Args:
+        c_path (str): The path of the classifier file.
+        useGpu (bool): Whether the tool should run on the GPU.
+
+    Returns:
+        SegmentationTool: The tool, ready to segment.
+    """
+    key   = "stm.model-" + ("gpu" if useGpu else "cpu")
+    stamp = [c_path, os.path.getmtime(c_path)]
+    known = IJ.getProperty(key)
+    if (known is not None) and (list(known[0]) == stamp):
+        return known[1]
+
+    IJ.log("  > Loading the classifier: " + os.path.basename(c_path))
+    sc = SegmentationTool()
+    sc.openModel(c_path)
+    sc.setUseGpu(useGpu)
+    IJ.setProperty(key, [stamp, sc])
+    return sc
+
+
+def runClassifier(image, c_path):
+    """
+    Runs the pixel classifier on an image.
+    The first time, the GPU is tried, and the backend that worked is remembered for the whole session ('stm.backend' property).
+    If the GPU was found to work but fails on this image, the CPU is used for this image only.
+
+    Args:
+        image (ImagePlus): The image to classify.
+        c_path (str): The path of the classifier file.
+
+    Returns:
+        ImagePlus: A (virtual) image containing the index of the class of each voxel. None if the segmentation failed.
+    """
+    imgplus = ImagePlusAdapter.wrapImgPlus(image)
+    backend = IJ.getProperty("stm.backend")
+    result  = None
 
-    try:
-        IJ.log("  > Attempting segmentation on GPU.")
-        sc = SegmentationTool()
-        c_path = getClassifierPath()
-        sc.openModel(c_path)
-        sc.setUseGpu(True)
-        result = sc.segment(imgplus)
-    except Exception as e:
-        IJ.log("  > Failed to run on GPU, trying on CPU.")
-        tryGPU = False
+    if backend != "cpu":
+        try:
+            result = getSegmentationTool(c_path, True).segment(imgplus)
+            if backend is None:
+                IJ.setProperty("stm.backend", "gpu")
+        except (Exception, Throwable) as e:
+            IJ.log("  > Failed to run on GPU, trying on CPU.")
+            if backend is None:
+                IJ.setProperty("stm.backend", "cpu")
+                IJ.setProperty("stm.model-gpu", None)
     
-    if not tryGPU:
+    if result is None:
         try:
-            sc = SegmentationTool()
-            sc.openModel(c_path)
-            sc.setUseGpu(False)
-            result = sc.segment(imgplus)
-        except Exception as e:
-            IJ.log("  > Error: ", e)
+            result = getSegmentationTool(c_path, False).segment(imgplus)
+        except (Exception, Throwable) as e:
+            IJ.log("  > Error: " + str(e))
             IJ.log("  > Segmentation failed on CPU.")
-            return 1
+            return None
 
-    output = ImageJFunctions.wrap(result, "segmented") # wraps the ImgPlus as an ImagePlus
-    raw_seg = output.duplicate()
-    output.close()
-    
-    IJ.log("  > Isolating labels of interest")
-    interest_labels = [1, 2, 3, 6]
-    labelsOut = keepLabels(raw_seg, interest_labels)
-    raw_seg.close()
-
-    IJ.log("  > Creating a mask from labels")
-    stackOut = ImageStack()
-    for s in range(1, labelsOut.getNSlices()+1):
-        labelsOut.setSlice(s)
-        prc = labelsOut.getProcessor()
-        prc.setThreshold(1, max(interest_labels))
-        stackOut.addSlice(prc.createMask())
+    return ImageJFunctions.wrap(result, "segmented") # wraps the ImgPlus as an ImagePlus
 
-    mask = ImagePlus("mask-"+title, stackOut)
 
-    # Clearing first and last slice to recover padding.
+def segmentWhole(image, c_path, maskLabels):
+    """
+    Classifies the whole image at once, and converts the labels to a mask in a single pass.
+
+    Returns:
+        list: The slices (ByteProcessor) of the mask. None if the segmentation failed.
+    """
+    IJ.log("  > Running the pixels classification.")
+    labels = runClassifier(image, c_path)
+    if labels is None:
+        return None
+    stack = labelsToMask(labels.getStack(), maskLabels, True)
+    labels.close()
+    return [stack.getProcessor(i) for i in range(1, stack.getSize()+1)]
+
+
+def listBlocks(image, tileSize, tileDepth, halo):
+    """
+    Splits an image in blocks, each one extended by a halo on all sides (clamped to the image).
+
+    Args:
+        image (ImagePlus): The image to split.
+        tileSize (int): The size (in pixels) of the blocks in X and Y. 0 for a single block.
+        tileDepth (int): The number of slices of the blocks. 0 to use the whole depth.
+        halo (int): The margin (in pixels) added around each block.
+
+    Returns:
+        list: Tuples (core, extended) of boxes (x, y, z, width, height, depth), z starting at 0.
+    """
+    width, height, nSlices = image.getWidth(), image.getHeight(), image.getNSlices()
+    tileSize  = tileSize if tileSize > 0 else max(width, height)
+    tileDepth = tileDepth if tileDepth > 0 else nSlices
+    blocks = []
+    for z0 in range(0, nSlices, tileDepth):
+        for y0 in range(0, height, tileSize):
+            for x0 in range(0, width, tileSize):
+                w, h, d = min(tileSize, width-x0), min(tileSize, height-y0), min(tileDepth, nSlices-z0)
+                xa, ya, za = max(0, x0-halo), max(0, y0-halo), max(0, z0-halo)
+                xb, yb, zb = min(width, x0+w+halo), min(height, y0+h+halo), min(nSlices, z0+d+halo)
+                blocks.append(((x0, y0, z0, w, h, d), (xa, ya, za, xb-xa, yb-ya, zb-za)))
+    return blocks
+
+
+def cropBlock(image, box):
+    """
+    Copies a box of an image (all channels) in a new image.
+
+    Args:
+        image (ImagePlus): The image to crop.
+        box (tuple): The box (x, y, z, width, height, depth), z starting at 0.
+
+    Returns:
+        ImagePlus: The cropped image.
+    """
+    x, y, z, w, h, d = box
+    stack = image.getStack()
+    nChannels = image.getNChannels()
+    block = ImageStack(w, h)
+    for s in range(z, z+d):
+        for c in range(1, nChannels+1):
+            prc = stack.getProcessor(image.getStackIndex(c, s+1, 1))
+            prc.setRoi(x, y, w, h)
+            block.addSlice(prc.crop())
+    imBlock = ImagePlus("block", block)
+    imBlock.setDimensions(nChannels, d, 1)
+    imBlock.setCalibration(image.getCalibration())
+    return imBlock
+
+
+def insertLabels(masks, labels, core, ext, maskLabels):
+    """
+    Converts the core of a block of labels to a mask, and writes it in the final mask.
+    The first and last slices of the final mask are left empty, as they are the padding added by the preprocessing.
+
+    Args:
+        masks (list): The slices (ByteProcessor) of the final mask.
+        labels (ImagePlus): The labels of the extended block.
+        core (tuple): The box of the core of the block.
+        ext (tuple): The box of the extended block.
+        maskLabels (list): The labels to keep in the mask.
+    """
+    x0, y0, z0, w, h, d = core
+    xa, ya, za = ext[:3]
+    lblStack = labels.getStack()
+    table = labelsTable(maskLabels, 256 if lblStack.getBitDepth() == 8 else 65536)
+    for z in range(max(z0, 1), min(z0+d, len(masks)-1)):
+        prc = lblStack.getProcessor(z-za+1)
+        prc.setRoi(x0-xa, y0-ya, w, h)
+        masks[z].insert(maskFromLabels(prc.crop(), maskLabels, table), x0, y0)
+
+
+def segmentTiled(image, c_path, tileSize, tileDepth, halo, maskLabels):
+    """
+    Classifies the image block by block, so the memory used by the classifier only depends on the size of the blocks.
+    Each block is extended by a halo so the features computed at its core are close to the ones of the whole image.
+    A few voxels of the mask along the borders of the blocks may still differ from a whole-image classification.
+    Only the core of each block is kept: it is converted to a mask and written directly in the final mask.
+
+    Args:
+        image (ImagePlus): The preprocessed image.
+        c_path (str): The path of the classifier file.
+        tileSize (int): The size (in pixels) of the blocks in X and Y.
+        tileDepth (int): The number of slices of the blocks. 0 to use the whole depth.
+        halo (int): The margin (in pixels) added around each block.
+        maskLabels (list): The labels to keep in the mask.
+
+    Returns:
+        list: The slices (ByteProcessor) of the mask. None if the segmentation failed.
+    """
+    masks  = [ByteProcessor(image.getWidth(), image.getHeight()) for _ in range(image.getNSlices())]
+    blocks = listBlocks(image, tileSize, tileDepth, halo)
+
+    for i, (core, ext) in enumerate(blocks):
+        IJ.log("  > Running the pixels classification on block " + str(i+1) + "/" + str(len(blocks)))
+        imBlock = cropBlock(image, ext)
+        labels = runClassifier(imBlock, c_path)
+        imBlock.close()
+        if labels is None:
+            return None
+        insertLabels(masks, labels, core, ext, maskLabels)
+        labels.close()
+
+    return masks
+
+
+def getSegmenter(c_path):
+    """
+    Loads the classifier as a LabKit 'Segmenter', which gives access to the features and to the random forest separately.
+    It is kept for the whole session, like the segmentation tools.
+
+    Args:
+        c_path (str): The path of the classifier file.
+
+    Returns:
+        Segmenter: The classifier.
+    """
+    stamp = [c_path, os.path.getmtime(c_path)]
+    known = IJ.getProperty("stm.segmenter")
+    if (known is not None) and (list(known[0]) == stamp):
+        return known[1]
+    context = IJ.runPlugIn("org.scijava.Context", "")
+    with open(c_path, 'r') as f:
+        segmenter = Segmenter.fromJson(context, JsonParser().parse(f.read()))
+    IJ.setProperty("stm.segmenter", [stamp, segmenter])
+    return segmenter
+
+
+def getFeaturesSignature(c_path):
+    """
+    The features computed by a classifier only depend on the 'features' entry of its file.
+    Two classifiers having the same signature can share the feature stacks.
+
+    Args:
+        c_path (str): The path of the classifier file.
+
+    Returns:
+        str: The hash of the features settings.
+    """
+    return getClassifierInfo(c_path)[1]
+
+
+def segmentFromFeatures(image, c_path, tileSize, tileDepth, halo, store, maskLabels):
+    """
+    Classifies the image block by block, like 'segmentTiled', but the features of each block are saved in an N5 container (chunked and compressed).
+    If the container is complete, the features are read from it and only the random forest is evaluated.
+    The container must be specific to the image, the features settings and the blocks geometry.
+
+    Args:
+        image (ImagePlus): The preprocessed image.
+        c_path (str): The path of the classifier file.
+        tileSize (int): The size (in pixels) of the blocks in X and Y. 0 for a single block.
+        tileDepth (int): The number of slices of the blocks. 0 to use the whole depth.
+        halo (int): The margin (in pixels) added around each block.
+        store (str): The path of the N5 container.
+        maskLabels (list): The labels to keep in the mask.
+
+    Returns:
+        list: The slices (ByteProcessor) of the mask.
+    """
+    segmenter  = getSegmenter(c_path)
+    calculator = segmenter.features()
+    prediction = CpuRandomForestPrediction(segmenter.getClassifier(), calculator.count())
+    masks  = [ByteProcessor(image.getWidth(), image.getHeight()) for _ in range(image.getNSlices())]
+    blocks = listBlocks(image, tileSize, tileDepth, halo)
+    n5     = N5FSWriter(store)
+    reuse  = n5.getAttribute("/", "complete", Boolean) is not None
+
+    for i, (core, ext) in enumerate(blocks):
+        dataset = "block-" + str(i)
+        x0, y0, z0, w, h, d = core
+        if reuse:
+            IJ.log("  > Reading the features of block " + str(i+1) + "/" + str(len(blocks)))
+            features = N5Utils.open(n5, dataset)
+        else:
+            IJ.log("  > Computing the features of block " + str(i+1) + "/" + str(len(blocks)))
+            imBlock = cropBlock(image, ext)
+            data = ImageJFunctions.wrapReal(imBlock)
+            if imBlock.getNChannels() > 1: # (X, Y, C, Z) -> (X, Y, Z, C)
+                data = Views.moveAxis(data, 2, data.numDimensions()-1)
+            xa, ya, za = ext[:3]
+            interval = FinalInterval([x0-xa, y0-ya, z0-za], [x0-xa+w-1, y0-ya+h-1, z0-za+d-1])
+            features = Views.zeroMin(calculator.apply(Views.extendBorder(data), interval))
+            N5Utils.save(features, n5, dataset, [64, 64, 16, 8], GzipCompression())
+            imBlock.close()
+        out = ArrayImgs.unsignedBytes(w, h, d)
+        prediction.segment(features, out)
+        labels = ImageJFunctions.wrap(out, "labels")
+        insertLabels(masks, labels, core, (x0, y0, z0), maskLabels)
+        labels.close()
+
+    if not reuse:
+        n5.setAttribute("/", "complete", True)
+    now = time.time()
+    os.utime(store, (now, now))
+    return masks
+
+
+def segmentImage(image, options=None):
+    """
+    Runs the pixel classifier on a preprocessed image and builds the rough mask from its labels.
+    The mask is made pseudo-isotropic, unless the 'isotropic' option is False. In this case, the anisotropy factor is 1.0.
+    If the 'tileSize' option is not 0, the image is classified by blocks (see 'segmentTiled').
+    The input image is not closed.
+
+    Args:
+        image (ImagePlus): The preprocessed image (output of the f1 stage).
+        options (dict): The options. If None, they are read from 'options.json'.
+
+    Returns:
+        ImagePlus: The rough mask, with its 'anisotropy-factor' and 'z-mapping' (values used to invert the Z axis of the spots) properties set (and the crop properties of the input). None if the segmentation failed.
+    """
+    if options is None:
+        options = getOptions() or {}
+    clb = image.getCalibration()
+    title = image.getTitle()
+    c_path = getClassifierPath()
+    if c_path is None:
+        IJ.log("  > No classifier found.")
+        return None
+    maskLabels = options.get('maskLabels', [1, 2, 3, 6])
+    tileSize  = options.get('tileSize', 0)
+    tileDepth = options.get('tileDepth', 0)
+    halo      = options.get('tileHalo')
+    if (tileSize <= 0) and (tileDepth <= 0):
+        halo = 0 # Single block, no margin needed.
+    elif halo is None:
+        halo = getFeatureHalo(c_path)
+    masks = None
+
+    # The features can only be attached to an image coming from the cache.
+    upstream = image.getProperty("cache-key")
+    if options.get('cacheFeatures', False) and (upstream is not None):
+        key = stageKey('features', options, upstream, getFeaturesSignature(c_path))
+        cacheDir = options.get('cacheDir') or getCacheDir()
+        try:
+            store = os.path.join(cacheDir, key + ".n5")
+            masks = segmentFromFeatures(image, c_path, tileSize, tileDepth, halo, store, maskLabels)
+            if not os.path.isfile(os.path.join(cacheDir, key + ".size")):
+                cacheRecordSize(store)
+            # The features have their own budget, so they don't evict the products (nor themselves).
+            cacheEvict(cacheDir, int(options.get('featuresCacheSize', 100) * 1024 * 1024 * 1024), True)
+        except (Exception, Throwable) as e:
+            IJ.log("  > Couldn't use the features cache (" + str(e) + "), running the regular classification.")
+            masks = None
+
+    if (masks is None) and (tileSize > 0):
+        IJ.log("  > Tiled classification: " + str(tileSize) + " pixels blocks, with a halo of " + str(halo) + " pixels.")
+        masks = segmentTiled(image, c_path, tileSize, tileDepth, halo, maskLabels)
+    elif masks is None:
+        masks = segmentWhole(image, c_path, maskLabels)
+    if masks is None:
+        return None
+    IJ.log("  > Mask created from labels " + str(maskLabels))
+
+    stackOut = ImageStack(image.getWidth(), image.getHeight())
+    for prc in masks:
+        stackOut.addSlice(prc)
+    mask = ImagePlus("mask-"+title, stackOut)
     mask.setCalibration(clb)
-    mask.setSlice(1)
-    mask.getProcessor().max(0)
-    mask.setSlice(mask.getNSlices())
-    mask.getProcessor().max(0)
-    labelsOut.close()
-
-    imOut, f = makeIsotropic(mask)
-    IJ.log("  > Transform mask into pseudo-isotropic stack.")
+    mapping = ",".join([str(v) for v in isotropicZMapping(clb.pixelWidth, clb.pixelDepth, mask.getNSlices())]) # Whatever the output grid.
+
+    if options.get('isotropic', True):
+        imOut, f = makeIsotropic(mask, options.get('isoVoxelSize'), True)
+        IJ.log("  > Transform mask into pseudo-isotropic stack.")
+    else:
+        imOut, f = mask, 1.0
     imOut.setProperty("anisotropy-factor", str(f))
-    imOut.setProperty("invalid-spots-path", ppt)
+    imOut.setProperty("z-mapping", mapping)
+    transferCrop(image, imOut)
     IJ.log("     | Anisotropy factor: " + str(f))
+    return imOut
+
+
+def main():
+    image = IJ.getImage()
+    ppt = image.getProperty("invalid-spots-path")
+    title = image.getTitle().replace("1-preprocessed-", "2-rough-mask-")
+
+    IJ.log("=======  Starting pixels classification  ========")
+
+    # The cached mask can only be used if the input comes from the cache of the f1 stage.
+    options  = getOptions() or {}
+    upstream = image.getProperty("cache-key")
+    c_path   = getClassifierPath()
+    if c_path is None:
+        IJ.log("Couldn't find the pixel classifier.")
+        return 1
+    key = None
+    if options.get('useCache', False) and (upstream is not None):
+        key = stageKey('segment', options, upstream, os.path.basename(c_path))
+    imOut = cachedProduct(key, lambda: segmentImage(image, options), ["anisotropy-factor", "z-mapping"] + CROP_PROPERTIES)
+    if imOut is None:
+        return 1
+
+    imOut.setProperty("invalid-spots-path", ppt)
     imOut.setTitle(title)
     imOut.show()
     IJ.log("==> Rough segmentation DONE.")
@@ -16,6 +16,9 @@ def setOptions(path):
     chSpots = 1
     chMembrane = 3
     sizeHoles = 2000
+    chExtra = []
+    tileSize = 0
+    options = {}
 
     if os.path.isfile(options_path):
         with open(options_path, 'r') as f:
@@ -23,22 +26,31 @@ def setOptions(path):
             chSpots = options['chSpots']
             chMembrane = options['chMembrane']
             sizeHoles = options['sizeHoles']
+            chExtra = options.get('chExtra', [])
+            tileSize = options.get('tileSize', 0)
 
     gd = GenericDialog("Set options")
     gd.addNumericField("Channel spots", chSpots, 0)
     gd.addNumericField("Channel membrane", chMembrane, 0)
     gd.addNumericField("Size holes", sizeHoles, 0)
+    gd.addStringField("Extra channels", ", ".join([str(c) for c in chExtra]))
+    gd.addNumericField("Tile size", tileSize, 0)
     gd.showDialog()
     if (gd.wasCanceled()):
         return
     chSpots = int(gd.getNextNumber())
     chMembrane = int(gd.getNextNumber())
     sizeHoles = int(gd.getNextNumber())
-    options = {
+    chExtra = [int(c) for c in gd.getNextString().split(',') if c.strip()]
+    tileSize = int(gd.getNextNumber())
+    # Options that are not in the dialog (ex: 'tileHalo') are kept as they are.
+    options.update({
         "chSpots": chSpots,
         "chMembrane": chMembrane,
-        "sizeHoles": sizeHoles
-    }
+        "sizeHoles": sizeHoles,
+        "chExtra": chExtra,
+        "tileSize": tileSize
+    })
     with open(options_path, 'w') as f:
         json.dump(options, f)
 
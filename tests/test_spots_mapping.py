@@ -0,0 +1,29 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "jars", "Lib"))
+
+from spots_to_membrane.spotsMapping import isotropicZMapping, invertZ
+
+
+def baselineMapping(pixelWidth, pixelDepth, nSlices):
+    # Mapping read from the isotropic mask itself, before the mapping was stored as a property.
+    factor = pixelDepth / pixelWidth
+    isoDepth = pixelWidth # Z step of the isotropic mask
+    isoSlices = int(nSlices * factor) # As in 'makeIsotropic'
+    return isoDepth * isoSlices, isoDepth / factor
+
+
+def test_isotropic_mapping_matches_baseline():
+    for xy, z, n in [(0.1, 0.5, 22), (0.065, 0.3, 41), (0.2, 0.2, 10), (0.1, 0.35, 17)]:
+        extent, offset = isotropicZMapping(xy, z, n)
+        bExtent, bOffset = baselineMapping(xy, z, n)
+        assert abs(extent - bExtent) < 1e-9
+        assert abs(offset - bOffset) < 1e-9
+
+
+def test_spot_position():
+    extent, offset = isotropicZMapping(0.1, 0.5, 22)
+    assert abs(extent - 11.0) < 1e-9
+    assert abs(offset - 0.02) < 1e-9
+    assert abs(invertZ(3.3, extent, offset) - 7.72) < 1e-9